@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Offline audio onset harness for oddball10.py.
+
+Runs the trial loop unattended with SDL's disk audio driver and dummy video
+driver, finds tone onsets in the PCM the mixer wrote, and compares them with
+the sound_onset_ns values in the session log. Prints a jitter/latency report
+per mixer buffer size; with --max-jitter-ms it exits non-zero when a buffer
+size exceeds the limit, so it can run in CI.
+
+The disk driver paces its writes with a whole-millisecond sleep per buffer, so
+its sample clock does not run at the nominal rate. The file's time base is
+therefore fitted against the log: jitter is the scatter around that fit and
+latency is its offset from the moment the mixer was opened. That offset includes
+the driver's own write scheduling, so compare it between harness runs rather
+than reading it as a device latency.
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "oddball10.py")
+
+ONSET_THRESHOLD = 0.05  # Fraction of full scale the rectified signal must cross
+MIN_GAP_MS = 20         # Quieter stretches shorter than this belong to the same tone
+
+def run_session(workdir, buffer_size, args):
+    settings = {
+        "user_name": "harness", "audio_buffer": buffer_size,
+        "trials": args.trials, "stim_duration": args.stim_duration, "isi": args.isi, "blocks": 1,
+        "fixation_duration": 0, "fixation_cross": False, "isi_distribution": "fixed", "stim_type": args.stim_type
+    }
+    settings_path = os.path.join(workdir, "autorun.json")
+    with open(settings_path, 'w') as f:
+        json.dump(settings, f)
+    pcm_path = os.path.join(workdir, "audio.raw")
+    env = dict(os.environ, SDL_AUDIODRIVER="disk", SDL_DISKAUDIOFILE=pcm_path, SDL_VIDEODRIVER="dummy",
+               ODDBALL_AUTORUN=settings_path)
+    subprocess.run([sys.executable, SCRIPT], cwd=workdir, env=env, check=True, timeout=args.timeout,
+                   stdout=subprocess.DEVNULL)
+    log_path, = glob.glob(os.path.join(workdir, "oddball_log_*.csv"))
+    return pcm_path, log_path
+
+def read_log(log_path):
+    # Session settings, the session start anchor and one sound onset per trial
+    settings, sound_onsets = {}, {}
+    with open(log_path, newline='') as f:
+        for row in csv.DictReader(f):
+            if row['trial'] == 'setting':
+                settings[row['stim_type']] = row['value']
+            elif row['trial'] == 'anchor' and row['stim_type'] == 'session_start':
+                session_start_wall_ns = int(row['wall_clock_ns']) - int(row['session_ns'])
+            elif row['sound_onset_ns']:
+                sound_onsets[int(row['trial'])] = int(row['sound_onset_ns'])
+    audio_open_ns = int(settings['audio_open_wall_ns']) - session_start_wall_ns
+    return settings, audio_open_ns, np.array([sound_onsets[t] for t in sorted(sound_onsets)], dtype=np.int64)
+
+def detect_onsets(pcm_path, rate, channels):
+    # Rectified envelope: a tone starts at the first sample over threshold that
+    # follows at least MIN_GAP_MS of quiet
+    pcm = np.fromfile(pcm_path, dtype=np.int16).reshape(-1, channels)
+    loud = np.flatnonzero(np.abs(pcm.astype(np.int32)).max(axis=1) > ONSET_THRESHOLD * 32767)
+    gaps = np.diff(loud, prepend=-rate)
+    return loud[gaps > rate * MIN_GAP_MS // 1000]
+
+def measure(buffer_size, args):
+    with tempfile.TemporaryDirectory() as workdir:
+        pcm_path, log_path = run_session(workdir, buffer_size, args)
+        settings, audio_open_ns, logged_ns = read_log(log_path)
+        rate, channels = int(settings['audio_rate']), int(settings['audio_channels'])
+        onsets = detect_onsets(pcm_path, rate, channels)
+    result = {'buffer': buffer_size, 'buffer_ms': buffer_size * 1000 / rate, 'trials': len(logged_ns), 'onsets': len(onsets)}
+    if len(onsets) != len(logged_ns) or len(onsets) < 3:
+        return result
+    # Fit file sample index against log time, anchored at the mixer open time
+    rel_ns = logged_ns - audio_open_ns
+    slope, intercept = np.polyfit(rel_ns, onsets, 1)
+    residual_ms = (onsets - (slope * rel_ns + intercept)) / slope / 1e6
+    result.update({
+        'latency_ms': -intercept / slope / 1e6,
+        'jitter_sd_ms': residual_ms.std(),
+        'jitter_pp_ms': np.ptp(residual_ms),
+        'clock_ratio': slope * 1e9 / rate
+    })
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--buffers', type=int, nargs='+', default=[256, 512, 1024], help="mixer buffer sizes in samples")
+    parser.add_argument('--trials', type=int, default=40)
+    parser.add_argument('--stim-duration', type=int, default=100, help="tone length in ms")
+    parser.add_argument('--isi', type=int, default=300, help="inter-stimulus interval in ms")
+    parser.add_argument('--stim-type', choices=["both", "audio"], default="both")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds allowed per session")
+    parser.add_argument('--max-jitter-ms', type=float, help="fail if any buffer size's jitter SD exceeds this")
+    parser.add_argument('--csv', help="also write the report to this file")
+    args = parser.parse_args()
+
+    results = [measure(buffer_size, args) for buffer_size in args.buffers]
+    columns = ['buffer', 'buffer_ms', 'trials', 'onsets', 'latency_ms', 'jitter_sd_ms', 'jitter_pp_ms', 'clock_ratio']
+    print(" ".join(f"{c:>12}" for c in columns))
+    for r in results:
+        print(" ".join(f"{r[c]:>12.3f}" if isinstance(r.get(c), float) else f"{r.get(c, '-')!s:>12}" for c in columns))
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(results)
+
+    failed = [r['buffer'] for r in results if 'jitter_sd_ms' not in r]
+    if failed:
+        print(f"Onset count didn't match the log for buffer sizes {failed}")
+    if args.max_jitter_ms is not None:
+        failed += [r['buffer'] for r in results if r.get('jitter_sd_ms', 0) > args.max_jitter_ms]
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
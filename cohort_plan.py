@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Cohort counterbalancing for oddball10.py.
+
+Assigns every participant in a cohort to one cell of a counterbalanced design
+and writes a settings file per participant, which oddball10.py loads by
+participant name. The factors are stimulus modality, tone mapping and shape
+mapping. Each is either crossed between participants, or, with --within, run as
+blocks whose order follows a balanced Latin square (Williams design), so every
+level appears equally often at every block position and directly follows every
+other level equally often.
+
+Participants are assigned in permuted blocks: each run of as many participants
+as there are cells covers every cell once in random order, so cell counts never
+differ by more than one whatever the cohort size.
+
+    python cohort_plan.py assign cohort_settings --size 48 --modality both audio visual --within modality
+    python cohort_plan.py check cohort_settings
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import numpy as np
+
+# Factor levels and the oddball10.py settings each one sets
+FACTORS = {
+    "modality": {
+        "both": {"stim_type": "both"},
+        "audio": {"stim_type": "audio"},
+        "visual": {"stim_type": "visual"},
+    },
+    "tone_mapping": {  # Standard and target tone in Hz
+        "high_target": {"tones": [1000, 1500]},
+        "low_target": {"tones": [1500, 1000]},
+        "high_target_wide": {"tones": [750, 1250]},  # oddball6.py's pair
+        "low_target_wide": {"tones": [1250, 750]},
+    },
+    "shape_mapping": {  # Standard and target shape
+        "triangle_target": {"shapes": ["circle", "triangle"]},
+        "star_target": {"shapes": ["circle", "star"]},
+        "circle_target": {"shapes": ["triangle", "circle"]},
+    },
+}
+DEFAULT_LEVELS = {"modality": ["both"], "tone_mapping": ["high_target"], "shape_mapping": ["triangle_target"]}
+
+def balanced_latin_square(n):
+    # Williams design: rows are block orders of levels 0..n-1. Odd n needs the
+    # mirrored rows as well to balance first-order carryover.
+    first = np.empty(n, dtype=int)
+    first[0::2] = np.arange((n + 1) // 2)
+    first[1::2] = (n - np.arange(1, n // 2 + 1)) % n
+    square = (first + np.arange(n)[:, None]) % n
+    return square if n % 2 == 0 else np.concatenate((square, square[:, ::-1]))
+
+def assign(size, levels, within, rng):
+    # Cell index per participant, plus the cell table: one row per cell with a
+    # level index per between factor and the Latin square row for block order
+    between = [f for f in FACTORS if f != within]
+    orders = balanced_latin_square(len(levels[within])) if within else np.zeros((1, 1), dtype=int)
+    cells = np.array(list(itertools.product(*(range(len(levels[f])) for f in between), range(len(orders)))), dtype=int)
+    reps = -(-size // len(cells))
+    assignment = np.argsort(rng.random((reps, len(cells))), axis=1).ravel()[:size]
+    return assignment, cells, between, orders
+
+def participant_settings(participant, cell, cells, between, within, orders, levels):
+    chosen = {f: levels[f][i] for f, i in zip(between, cells[cell][:-1])}
+    base = {}
+    for f, level in chosen.items():
+        base.update(FACTORS[f][level])
+    blocks = [dict(base)]
+    if within:
+        order = [levels[within][i] for i in orders[cells[cell][-1]]]
+        chosen["block_order"] = order
+        blocks = [dict(base, **FACTORS[within][level]) for level in order]
+    return {"participant": participant, "cell": int(cell), "cells": len(cells), "levels": chosen, "within": within, "blocks": blocks}
+
+def settings_path(directory, participant):
+    return os.path.join(directory, f"{participant}.json")
+
+def load_settings(directory, participant):
+    # The participant's settings, or None if they aren't in a planned cohort
+    try:
+        with open(settings_path(directory, participant)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def cmd_assign(args):
+    levels = {f: getattr(args, f) or DEFAULT_LEVELS[f] for f in FACTORS}
+    for f, chosen in levels.items():
+        unknown = set(chosen) - set(FACTORS[f])
+        if unknown:
+            sys.exit(f"Unknown {f} level(s): {', '.join(sorted(unknown))}")
+    if args.within and len(levels[args.within]) < 2:
+        sys.exit(f"--within {args.within} needs at least two levels")
+    if args.ids_file:
+        with open(args.ids_file) as f:
+            participants = [line.strip() for line in f if line.strip()]
+    else:
+        width = len(str(args.size))
+        participants = [f"{args.prefix}{i:0{width}d}" for i in range(1, args.size + 1)]
+
+    assignment, cells, between, orders = assign(len(participants), levels, args.within, np.random.default_rng(args.seed))
+    os.makedirs(args.directory, exist_ok=True)
+    with open(os.path.join(args.directory, "assignments.csv"), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["participant", "cell"] + between + (["block_order"] if args.within else []))
+        for participant, cell in zip(participants, assignment):
+            settings = participant_settings(participant, cell, cells, between, args.within, orders, levels)
+            with open(settings_path(args.directory, participant), 'w') as g:
+                json.dump(settings, g)
+            writer.writerow([participant, cell] + [settings["levels"][b] for b in between] +
+                            (["/".join(settings["levels"]["block_order"])] if args.within else []))
+    print(f"Assigned {len(participants)} participants to {len(cells)} cells in {args.directory}")
+
+def cmd_check(args):
+    # Reads every settings file back and reports cell counts, level counts per
+    # factor and, for a within factor, level counts per block position
+    with open(os.path.join(args.directory, "assignments.csv"), newline='') as f:
+        participants = [row["participant"] for row in csv.DictReader(f)]
+    all_settings = [load_settings(args.directory, p) for p in participants]
+    missing = [p for p, s in zip(participants, all_settings) if s is None]
+    if missing:
+        sys.exit(f"{len(missing)} settings file(s) missing, e.g. {missing[0]}")
+
+    cell_counts = np.bincount([s["cell"] for s in all_settings], minlength=all_settings[0]["cells"])
+    print(f"{len(all_settings)} participants, {len(cell_counts)} cells, {cell_counts.min()}-{cell_counts.max()} per cell")
+    for f in all_settings[0]["levels"]:
+        if f == "block_order":
+            continue
+        values, counts = np.unique([s["levels"][f] for s in all_settings], return_counts=True)
+        print(f"{f}: " + ", ".join(f"{v} {c}" for v, c in zip(values, counts)))
+    failed = cell_counts.max() - cell_counts.min() > args.tolerance
+    within = all_settings[0]["within"]
+    if within:
+        orders = np.array([s["levels"]["block_order"] for s in all_settings])
+        for position in range(orders.shape[1]):
+            values, counts = np.unique(orders[:, position], return_counts=True)
+            print(f"block {position + 1}: " + ", ".join(f"{v} {c}" for v, c in zip(values, counts)))
+        # A block order that isn't a permutation of the levels means a corrupted file
+        failed |= any(len(set(order)) != orders.shape[1] for order in orders)
+    print("Balanced" if not failed else "NOT balanced")
+    sys.exit(1 if failed else 0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    assign_parser = commands.add_parser("assign", help="assign a cohort and write settings files")
+    assign_parser.add_argument('directory', help="settings directory, created if missing")
+    who = assign_parser.add_mutually_exclusive_group(required=True)
+    who.add_argument('--size', type=int, help="number of participants, named <prefix><number>")
+    who.add_argument('--ids-file', help="file with one participant ID per line")
+    assign_parser.add_argument('--prefix', default="P")
+    for f in FACTORS:
+        assign_parser.add_argument('--' + f.replace('_', '-'), nargs='+', choices=list(FACTORS[f]),
+                                   help=f"levels to counterbalance (default: {' '.join(DEFAULT_LEVELS[f])})")
+    assign_parser.add_argument('--within', choices=list(FACTORS), help="factor run as blocks in Latin square order")
+    assign_parser.add_argument('--seed', type=int)
+    check_parser = commands.add_parser("check", help="verify the balance of an assigned cohort")
+    check_parser.add_argument('directory')
+    check_parser.add_argument('--tolerance', type=int, default=1, help="largest allowed difference between cell counts")
+    args = parser.parse_args()
+    if args.command == "assign":
+        cmd_assign(args)
+    else:
+        cmd_check(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Kernel-timestamped key input for oddball10.py.
+
+Reads struct input_event records straight from Linux input devices
+(/dev/input/event*) on a background thread, so a press is stamped by the kernel
+when it happens instead of when the trial loop gets round to polling it. Needs
+read access to the devices; oddball10.py falls back to pygame's key events when
+they can't be opened or the reader stops.
+"""
+
+import errno
+import os
+import select
+import struct
+import threading
+import time
+from collections import deque
+import pygame
+
+class EvdevKeyReader(threading.Thread):
+    # Presses and releases are pushed onto a deque, whose append/popleft are atomic, so the
+    # trial loop can drain it without taking a lock. A read error (e.g. the keyboard was
+    # unplugged) ends the thread and is kept in error; whatever was queued stays queued.
+    EVENT_FORMAT = 'llHHi'  # struct input_event: timeval, type, code, value
+    EVIOCSCLOCKID = 0x400445a0  # _IOW('E', 0xa0, int)
+    EV_KEY = 1
+    KEYS = {57: pygame.K_SPACE}  # evdev KEY_SPACE
+
+    def __init__(self, paths, clock_ns=time.monotonic_ns):
+        import fcntl  # Linux only, so not imported at the top
+        super().__init__(daemon=True)
+        if not paths:
+            raise OSError("no keyboard devices found")
+        self.queue = deque()
+        self.keys = set(self.KEYS.values())
+        self.clock_ns = clock_ns  # Clock the events' clock_ns are mapped onto
+        self.error = None
+        self.clocks = {}  # fd -> clock that device's timestamps are on
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                fcntl.ioctl(fd, self.EVIOCSCLOCKID, struct.pack('i', time.CLOCK_MONOTONIC))
+                self.clocks[fd] = time.monotonic_ns
+            except OSError:
+                self.clocks[fd] = time.time_ns  # Kernel default is CLOCK_REALTIME
+
+    def run(self):
+        size = struct.calcsize(self.EVENT_FORMAT)
+        try:
+            while True:
+                ready, _, _ = select.select(list(self.clocks), [], [])
+                for fd in ready:
+                    data = os.read(fd, size * 64)
+                    if not data:
+                        raise OSError(errno.ENODEV, "input device closed")
+                    # Map kernel timestamps onto clock_ns; the offset is read fresh so drift doesn't matter
+                    offset = self.clock_ns() - self.clocks[fd]()
+                    for sec, usec, type_, code, value in struct.iter_unpack(self.EVENT_FORMAT, data[:len(data) - len(data) % size]):
+                        if type_ == self.EV_KEY and value in (0, 1) and code in self.KEYS:  # Presses and releases, no repeats
+                            self.queue.append(pygame.event.Event(pygame.KEYDOWN if value else pygame.KEYUP, key=self.KEYS[code], unicode='',
+                                                                 clock_ns=sec * 1_000_000_000 + usec * 1000 + offset))
+        except OSError as e:
+            self.error = e
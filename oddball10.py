@@ -6,21 +6,73 @@ Created on Sat Mar 15 21:22:12 2025
 """
 
 import pygame
-import random
 import time
 import csv
 import math
+import os
+import glob
+import threading
+import queue
+import atexit
+import sys
+import json
+import socket
+import sqlite3
+from collections import OrderedDict
 import numpy as np
 from pygame import mixer
 from pygame import sndarray
+from session_plan import make_plan, load_plan, save_plan, plan_path, ISI_DISTRIBUTIONS
+from cohort_plan import load_settings as load_cohort_settings, settings_path as cohort_settings_path
+from evdev_input import EvdevKeyReader
+
+# Unattended runs (e.g. audio_harness.py): ODDBALL_AUTORUN names a JSON file with
+# the participant name and parameter values, keyed like AUTORUN_PARAMS below plus
+# "user_name", "isi_distribution", "stim_type", "fixation_cross" and "audio_buffer".
+# Menus, prompts and the countdown are skipped and the script exits after saving.
+AUTORUN_FILE = os.environ.get("ODDBALL_AUTORUN")
+autorun = None
+if AUTORUN_FILE:
+    with open(AUTORUN_FILE) as f:
+        autorun = json.load(f)
+AUTORUN_PARAMS = ("trials", "stim_duration", "isi", "blocks", "fixation_duration", "target_pulse", "standard_pulse")
+
+# Audio: LOW_LATENCY_AUDIO opens the mixer with a small buffer. Tones are
+# synthesized in whatever rate and channel layout the device actually grants.
+LOW_LATENCY_AUDIO = False
+LOW_LATENCY_BUFFER = 256  # Samples per mixer buffer in low-latency mode
+AUDIO_BUFFER = LOW_LATENCY_BUFFER if LOW_LATENCY_AUDIO else 512  # 512 is pygame's default
+if autorun:
+    AUDIO_BUFFER = autorun.get("audio_buffer", AUDIO_BUFFER)
 
 # Initialize Pygame
+mixer.pre_init(44100, -16, 1, AUDIO_BUFFER)
 pygame.init()
-mixer.init(channels=1)
+mixer.init()
+audio_open_wall_ns = time.time_ns()  # Origin of the device's sample clock, wall clock since the session clock isn't set up yet
+SAMPLE_RATE, _, AUDIO_CHANNELS = mixer.get_init()
+
+# Session-level settings written at the top of every session log
+session_settings = [('audio_rate', SAMPLE_RATE), ('audio_channels', AUDIO_CHANNELS), ('audio_buffer', AUDIO_BUFFER),
+                    ('audio_open_wall_ns', audio_open_wall_ns)]
 
-# Screen setup - Resizable window
-WIDTH, HEIGHT = 1000, 800  # Default size
-screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
+# Frame-locked presentation: durations are rounded to whole display refreshes
+# and trial timing advances by counting vsynced flips instead of the wall clock
+FRAME_LOCKED = False
+FALLBACK_REFRESH_RATE = 60  # Assumed refresh rate when flips don't block on vsync
+
+# Screen setup - Resizable window, or FULLSCREEN at the display's native resolution
+# so frames skip the compositor
+FULLSCREEN = False
+NATIVE_SIZE = pygame.display.get_desktop_sizes()[0]
+WIDTH, HEIGHT = NATIVE_SIZE if FULLSCREEN else (1000, 800)  # Default size
+DISPLAY_FLAGS = (pygame.FULLSCREEN if FULLSCREEN else pygame.RESIZABLE) | (pygame.SCALED if FRAME_LOCKED else 0)  # vsync needs a renderer (SCALED)
+DISPLAY_VSYNC = 1 if FRAME_LOCKED else 0
+try:
+    screen = pygame.display.set_mode((WIDTH, HEIGHT), DISPLAY_FLAGS, vsync=DISPLAY_VSYNC)
+except pygame.error:
+    DISPLAY_VSYNC = 0  # No vsync on this driver, FrameClock paces flips itself
+    screen = pygame.display.set_mode((WIDTH, HEIGHT), DISPLAY_FLAGS)
 pygame.display.set_caption("Audiovisual Oddball Task")
 
 # Colors
@@ -39,29 +91,585 @@ TARGET_PULSE = 512    # Duration for target square pulse in ms
 ISI = 1000 
 NUM_BLOCKS = 1
 TARGET_PROB = 0.2
-ISI_VARIES = False
+LEADING_STANDARDS = 1  # Trials at the start of each block that are always standards
+MIN_STANDARDS_BETWEEN_TARGETS = 1
+MAX_RUN_LENGTH = None  # Longest run of one stimulus type after the leading standards, None = no limit
+SESSION_PLAN_DIR = "session_plans"  # Pre-generated plans (session_plan.py), looked up by participant name
+ISI_DISTRIBUTION = "fixed"  # Name in ISI_DISTRIBUTIONS; the ISI parameter is the range centre, or the SOA for fixed_soa
+ISI_SPREAD = 500  # Half-width of the uniform, exponential and default discrete ranges in ms
+ISI_SCALE = 500   # Time constant of the exponential distribution in ms
+ISI_VALUES = None  # ISIs for the discrete distribution in ms, None = the range's ends and centre
 STIM_TYPE = "both"
+TONES = (1000, 1500)  # Standard and target tone in Hz
+SHAPES = ("circle", "triangle")  # Standard and target shape: "circle", "triangle" or "star"
+COHORT_SETTINGS_DIR = "cohort_settings"  # Counterbalanced conditions (cohort_plan.py), looked up by participant name
 FIXATION_CROSS = True  # Default to True (checked)
 FIXATION_DURATION = 750  # Default to 750ms
 
-# Square for photo sensor (50x50 pixels in bottom right)
+# Square for photo sensor (50x50 pixels in bottom right, sized for the sensor so not scaled)
 SQUARE_SIZE = 50
 
+# Stimulus geometry in degrees of visual angle, used when the station's viewing
+# distance and physical screen width are set. Otherwise sizes are fractions of
+# the window height; the defaults match the original 1000x800 pixel layout.
+VIEWING_DISTANCE_CM = None
+SCREEN_WIDTH_CM = None
+STIMULUS_SIZE = (4.0, 0.25)   # Circle diameter and triangle height/base: (degrees, fraction)
+FIXATION_SIZE = (0.8, 0.05)   # Fixation cross arm span
+FIXATION_WIDTH = (0.08, 0.005)  # Fixation cross line width
+
+# Monotonic clock for all trial timing. CLOCK_MONOTONIC_RAW is never slewed by
+# NTP; perf_counter_ns is the portable fallback.
+if hasattr(time, 'CLOCK_MONOTONIC_RAW'):
+    def clock_ns():
+        return time.clock_gettime_ns(time.CLOCK_MONOTONIC_RAW)
+else:
+    clock_ns = time.perf_counter_ns
+
+# Console telemetry. Messages are queued with their arguments and formatted and
+# written by a background thread, so a slow terminal or SSH pipe never stalls
+# the trial loop. When the queue is full messages are dropped and counted.
+TELEMETRY_QUIET, TELEMETRY_INFO, TELEMETRY_TRIAL, TELEMETRY_DEBUG = range(4)
+TELEMETRY_LEVEL = TELEMETRY_TRIAL  # Most detailed level shown
+TELEMETRY_FILE = None  # Write to this file instead of the console
+TELEMETRY_QUEUE_SIZE = 1024
+
+class Telemetry(threading.Thread):
+    def __init__(self, level=TELEMETRY_LEVEL, path=TELEMETRY_FILE):
+        super().__init__(daemon=True)
+        self.level = level
+        self.out = open(path, 'a', buffering=1) if path else sys.stdout
+        self.queue = queue.Queue(TELEMETRY_QUEUE_SIZE)
+        self.dropped = 0
+        self.start()
+
+    def log(self, level, message, *args):
+        # message is a str.format template; args are formatted on the writer thread
+        if level > self.level:
+            return
+        try:
+            self.queue.put_nowait((message, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            message, args = item
+            self.out.write(message.format(*args) + "\n")
+            self.out.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.dropped:
+            self.out.write(f"Telemetry dropped {self.dropped} message(s)\n")
+        if self.out is not sys.stdout:
+            self.out.close()
+
+telemetry = Telemetry()
+atexit.register(telemetry.close)
+
+class SessionTimebase:
+    # Logged timestamps are integer ns since session start on clock_ns. Anchor
+    # pairs (session ns, wall-clock ns) let them be mapped onto external recordings.
+    def __init__(self):
+        self.start_ns = clock_ns()
+        self.anchors = []
+        self.anchor('session_start')
+
+    def since_start(self, t_ns):
+        return t_ns - self.start_ns
+
+    def anchor(self, label, block=None):
+        # Bracket the wall-clock read with two monotonic reads and take the midpoint
+        before = clock_ns()
+        wall_ns = time.time_ns()
+        after = clock_ns()
+        self.anchors.append({'block': block, 'trial': 'anchor', 'stim_type': label,
+                             'session_ns': self.since_start((before + after) // 2), 'wall_clock_ns': wall_ns})
+        return self.anchors[-1]
+
+LOG_FIELDS = ['block', 'trial', 'stim_type', 'reaction_time', 'correct', 'target', 'reported_targets',
+              'pulse_frames_requested', 'pulse_frames_delivered', 'stim_frames_requested', 'stim_frames_delivered',
+              'stim_onset_ns', 'onset_error_ns', 'diode_off_ns', 'stim_clear_ns', 'isi_blank_ns', 'dropped_frames',
+              'sound_onset_ns', 'av_asynchrony_ns',
+              'response_ns', 'session_ns', 'wall_clock_ns', 'value']
+
+# Trial records (one per response, plus one per trial without a correct response)
+# live in a preallocated structured array. "No value" is NaN for floats and the
+# smallest value of the type for integers.
+def missing(dtype):
+    return np.nan if dtype.kind == 'f' else np.iinfo(dtype).min
+
+TRIAL_DTYPE = np.dtype([('block', np.int32), ('trial', np.int32), ('target', np.int8), ('reaction_time', np.float64),
+                        ('correct', np.int8), ('response_ns', np.int64),
+                        ('pulse_frames_requested', np.int32), ('pulse_frames_delivered', np.int32),
+                        ('stim_frames_requested', np.int32), ('stim_frames_delivered', np.int32),
+                        ('stim_onset_ns', np.int64), ('onset_error_ns', np.int64), ('diode_off_ns', np.int64),
+                        ('stim_clear_ns', np.int64), ('isi_blank_ns', np.int64), ('dropped_frames', np.int32),
+                        ('sound_onset_ns', np.int64), ('av_asynchrony_ns', np.int64)])
+EMPTY_TRIAL = np.array(tuple(missing(TRIAL_DTYPE[name]) for name in TRIAL_DTYPE.names), dtype=TRIAL_DTYPE)
+
+class TrialStore:
+    # Sized for one row per planned trial; doubles when extra responses fill it
+    def __init__(self, capacity):
+        self.rows = np.full(max(1, capacity), EMPTY_TRIAL)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def append(self, **fields):
+        if self.n == len(self.rows):
+            grown = np.full(2 * len(self.rows), EMPTY_TRIAL)
+            grown[:self.n] = self.rows
+            self.rows = grown
+        for name, value in fields.items():
+            self.rows[name][self.n] = value
+        self.n += 1
+
+    def update(self, start, fields):
+        # Set fields on every row from start on (the current trial's records)
+        for name, value in fields.items():
+            self.rows[name][start:self.n] = missing(TRIAL_DTYPE[name]) if value is None else value
+
+    def csv_lines(self, start, stop):
+        # Format rows as LOG_FIELDS CSV lines, one column at a time
+        rows = self.rows[start:stop]
+        lines = None
+        for name in LOG_FIELDS:
+            if name == 'stim_type':
+                column = np.where(rows['target'] == 1, 'target', 'standard')
+            elif name in TRIAL_DTYPE.names:
+                values = rows[name]
+                column = np.where(np.isnan(values) if values.dtype.kind == 'f' else values == missing(values.dtype), '', values.astype(str))
+            else:
+                column = np.full(len(rows), '')
+            lines = column if lines is None else np.char.add(np.char.add(lines, ','), column)
+        return lines.tolist()
+
+class SessionLog:
+    # Streams log rows to disk while the session runs. add() and add_trials() only
+    # queue rows; flush() writes and fsyncs them and is called at safe points (the
+    # start of an ISI, block breaks) so disk I/O never lands in a stimulus window.
+    # The file keeps an _incomplete suffix until close('complete'), so a crashed or
+    # aborted session is still on disk up to its last safe point and marked as
+    # partial. close() also saves the trial records as a .npz next to the CSV and the
+    # deadline overshoots as oddball_timing_*.csv, and closes the key event log and
+    # the session database if there are any. However the session ends, including a
+    # quit mid-trial, the CSV gets every trial row the .npz and database get.
+    def __init__(self, user_name, timestamp, trials, database=None, keys=None, waits=None):
+        self.path = f"oddball_log_{user_name}_{timestamp}.csv"
+        self.partial_path = f"oddball_log_{user_name}_{timestamp}_incomplete.csv"
+        self.timing_path = f"oddball_timing_{user_name}_{timestamp}.csv"
+        self.trials = trials
+        self.database = database
+        self.keys = keys
+        self.waits = waits
+        self.trials_added = 0  # Trial store rows queued so far
+        self.closed = False
+        self.file = open(self.partial_path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=LOG_FIELDS)
+        self.writer.writeheader()
+        self.pending = []  # Row dicts, and slices of trial store rows
+
+    def add(self, rows):
+        self.pending.extend(rows)
+
+    def add_trials(self, start, stop):
+        self.pending.append(slice(start, stop))
+        self.trials_added = stop
+
+    def flush(self):
+        if not self.pending:
+            return
+        for item in self.pending:
+            if isinstance(item, slice):
+                self.file.writelines(line + '\r\n' for line in self.trials.csv_lines(item.start, item.stop))
+            else:
+                self.writer.writerow(item)
+        self.pending.clear()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self, status):
+        if self.closed:
+            return
+        self.closed = True
+        if self.trials_added < len(self.trials):  # Rows of a trial cut short by a quit
+            self.add_trials(self.trials_added, len(self.trials))
+        self.add([{'trial': 'status', 'stim_type': status}])
+        self.flush()
+        self.file.close()
+        if self.waits is not None:
+            with open(self.timing_path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['block', 'trial', 'event', 'overshoot_ns'])
+                writer.writerows((block, trial, '+'.join(name for bit, name in EVENT_NAMES.items() if kind & bit), overshoot)
+                                 for block, trial, kind, overshoot in self.waits)
+        path = self.path if status == 'complete' else self.partial_path
+        np.savez(path[:-len('.csv')] + '.npz', trials=self.trials.rows[:len(self.trials)])
+        if status == 'complete':
+            os.replace(self.partial_path, self.path)
+        if self.keys is not None:
+            self.keys.close()
+        if self.database is not None:
+            self.database.close(status)
+
+# Every KEYDOWN/KEYUP during the trial loop, for offline analysis of holds,
+# anticipations and repeated presses
+KEY_LOG_SIZE = 4096  # Events held between flushes; older ones are overwritten
+KEY_EVENT_DTYPE = np.dtype([('block', 'i4'), ('trial', 'i4'), ('down', 'i1'), ('key', 'i4'), ('session_ns', 'i8')])
+
+class KeyEventLog:
+    # Fixed-size ring buffer, so recording an event is one row assignment with no
+    # allocation. flush() appends everything since the last flush to
+    # oddball_keys_{user}_{timestamp}.csv and is called at block breaks; the
+    # session database reads the same rows into its key_events table.
+    def __init__(self, user_name, timestamp, capacity=KEY_LOG_SIZE):
+        self.path = f"oddball_keys_{user_name}_{timestamp}.csv"
+        self.rows = np.zeros(capacity, dtype=KEY_EVENT_DTYPE)
+        self.count = 0    # Events recorded
+        self.flushed = 0  # Events written (or overwritten before they could be)
+        self.overwritten = 0
+        with open(self.path, 'w', newline='') as f:
+            f.write(','.join(KEY_EVENT_DTYPE.names) + '\r\n')
+
+    def record(self, block, trial, down, key, session_ns):
+        self.rows[self.count % len(self.rows)] = (block, trial, down, key, session_ns)
+        self.count += 1
+
+    def since(self, start):
+        # Events recorded from the start-th on that haven't been overwritten yet
+        return self.rows[np.arange(max(start, self.count - len(self.rows)), self.count) % len(self.rows)]
+
+    def flush(self):
+        rows = self.since(self.flushed)
+        self.overwritten += self.count - self.flushed - len(rows)
+        if len(rows):
+            with open(self.path, 'a', newline='') as f:
+                np.savetxt(f, rows, fmt='%d', delimiter=',', newline='\r\n')
+        self.flushed = self.count
+
+    def close(self):
+        self.flush()
+        if self.overwritten:
+            telemetry.log(TELEMETRY_INFO, "Key event log overflowed, {} event(s) lost; raise KEY_LOG_SIZE", self.overwritten)
+
+# Optional SQLite database shared by every session run from the same directory,
+# next to the per-session CSVs. Set SESSION_DB to a file name to enable it.
+SESSION_DB = None  # e.g. "oddball_sessions.db"
+SESSION_DB_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS sessions (session_id INTEGER PRIMARY KEY, participant TEXT, started_at TEXT,
+                                     variant TEXT, parameters TEXT, status TEXT);
+CREATE INDEX IF NOT EXISTS sessions_participant ON sessions (participant);
+CREATE INDEX IF NOT EXISTS sessions_started_at ON sessions (started_at);
+CREATE INDEX IF NOT EXISTS sessions_variant ON sessions (variant);
+CREATE TABLE IF NOT EXISTS settings (session_id INTEGER, name TEXT, value);
+CREATE TABLE IF NOT EXISTS blocks (session_id INTEGER, block INTEGER, start_ns INTEGER, end_ns INTEGER,
+                                   start_wall_clock_ns INTEGER, reported_targets INTEGER);
+CREATE TABLE IF NOT EXISTS trials (session_id INTEGER, {', '.join(f"{name} {'REAL' if TRIAL_DTYPE[name].kind == 'f' else 'INTEGER'}" for name in TRIAL_DTYPE.names)});
+CREATE INDEX IF NOT EXISTS trials_session ON trials (session_id, block, trial);
+CREATE TABLE IF NOT EXISTS events (session_id INTEGER, block INTEGER, trial INTEGER, event TEXT, overshoot_ns INTEGER);
+CREATE INDEX IF NOT EXISTS events_session ON events (session_id, block, trial);
+CREATE TABLE IF NOT EXISTS key_events (session_id INTEGER, {', '.join(f"{name} INTEGER" for name in KEY_EVENT_DTYPE.names)});
+CREATE INDEX IF NOT EXISTS key_events_session ON key_events (session_id, block, trial);
+CREATE VIEW IF NOT EXISTS trial_log AS
+    SELECT participant, started_at, variant, trials.*, CASE target WHEN 1 THEN 'target' ELSE 'standard' END AS stim_type
+    FROM trials JOIN sessions USING (session_id);
+"""
+
+class SessionDatabase:
+    # Writes one session into SESSION_DB. The database runs in WAL mode so analysts
+    # can query it while a station is recording; rows are batched and inserted once
+    # per block (at the block break) with executemany on fixed statements. The
+    # trial_log view gives the per-trial CSV columns across all sessions.
+    TRIAL_INSERT = f"INSERT INTO trials VALUES (?, {', '.join('?' * len(TRIAL_DTYPE.names))})"
+    EVENT_INSERT = "INSERT INTO events VALUES (?, ?, ?, ?, ?)"
+    KEY_EVENT_INSERT = f"INSERT INTO key_events VALUES (?, {', '.join('?' * len(KEY_EVENT_DTYPE.names))})"
+    BLOCK_INSERT = "INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, path, user_name, variant, parameters, settings, trials, wait_log, keys):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SESSION_DB_SCHEMA)
+        self.trials, self.wait_log, self.keys = trials, wait_log, keys
+        self.trials_written = self.events_written = self.keys_written = 0
+        with self.db:
+            self.session_id = self.db.execute(
+                "INSERT INTO sessions (participant, started_at, variant, parameters, status) VALUES (?, datetime('now', 'localtime'), ?, ?, 'running')",
+                (user_name, variant, json.dumps(parameters))).lastrowid
+            self.db.executemany("INSERT INTO settings VALUES (?, ?, ?)", ((self.session_id, name, value) for name, value in settings))
+
+    def write_rows(self):
+        # Trials, timing events and key events added since the last write
+        sentinels = [missing(TRIAL_DTYPE[name]) for name in TRIAL_DTYPE.names]
+        rows = self.trials.rows[self.trials_written:len(self.trials)].tolist()
+        self.db.executemany(self.TRIAL_INSERT, ((self.session_id,) + tuple(None if v == m or v != v else v for v, m in zip(row, sentinels))
+                                                for row in rows))
+        self.db.executemany(self.EVENT_INSERT, ((self.session_id, block, trial, '+'.join(name for bit, name in EVENT_NAMES.items() if kind & bit), overshoot)
+                                                for block, trial, kind, overshoot in self.wait_log[self.events_written:]))
+        self.db.executemany(self.KEY_EVENT_INSERT, ((self.session_id,) + row for row in self.keys.since(self.keys_written).tolist()))
+        self.trials_written, self.events_written, self.keys_written = len(self.trials), len(self.wait_log), self.keys.count
+
+    def write_block(self, block, start_anchor, end_anchor, reported_targets):
+        with self.db:
+            self.db.execute(self.BLOCK_INSERT, (self.session_id, block, start_anchor['session_ns'], end_anchor['session_ns'],
+                                                start_anchor['wall_clock_ns'], reported_targets))
+            self.write_rows()
+
+    def close(self, status):
+        with self.db:
+            self.write_rows()
+            self.db.execute("UPDATE sessions SET status = ? WHERE session_id = ?", (status, self.session_id))
+        self.db.close()
+
+# Optional evdev input (Linux, needs read access to /dev/input): space presses are
+# read on a background thread (evdev_input.py) and stamped by the kernel instead
+# of by our polling loop. pygame KEYDOWN stays the fallback.
+INPUT_BACKEND = "pygame"  # "pygame" or "evdev"
+EVDEV_DEVICES = []  # Empty = every keyboard under /dev/input/by-id
+
+key_reader = None
+if INPUT_BACKEND == "evdev":
+    try:
+        key_reader = EvdevKeyReader(EVDEV_DEVICES or glob.glob('/dev/input/by-id/*-event-kbd'), clock_ns)
+        key_reader.start()
+    except (ImportError, OSError) as e:
+        telemetry.log(TELEMETRY_INFO, "evdev input unavailable ({}), using pygame key events", e)
+
+def poll_events():
+    global key_reader
+    events = pygame.event.get()
+    if key_reader is not None and key_reader.error is not None:
+        # The reader stopped: keep what it read and let pygame's key events through from now on
+        telemetry.log(TELEMETRY_INFO, "evdev input stopped ({}), using pygame key events", key_reader.error)
+        events.extend(key_reader.queue)
+        key_reader = None
+    elif key_reader is not None:
+        # Responses come from the reader; drop pygame's copy so they aren't counted twice
+        events = [e for e in events if not (e.type in (pygame.KEYDOWN, pygame.KEYUP) and e.key in key_reader.keys)]
+        while key_reader.queue:
+            events.append(key_reader.queue.popleft())
+    return events
+
+# Timed windows sleep coarsely until WAIT_GUARD_MS before their deadline and
+# then spin on clock_ns, so we keep sub-ms precision without pinning a core
+WAIT_GUARD_MS = 2
+WAIT_SLICE_MS = 5  # Longest single sleep, keeps event draining responsive
+# pygame key events carry no timestamp, so a press is timed when the poll after
+# a sleep drains it. While responses are open the sleeps are cut to this, which
+# puts pygame RTs at most ~0.5 ms late (about 0.25 ms on average) instead of up
+# to WAIT_SLICE_MS; evdev presses carry kernel timestamps and don't depend on it.
+# Frame-locked waits poll once per refresh whatever this is.
+WAIT_RESPONSE_SLICE_MS = 0.5
+
+class DeadlineWait:
+    # Iterate over this to drain pygame events until deadline_ns is reached.
+    # Handlers may push deadline_ns back (e.g. after a pause); overshoot_ns
+    # holds how late the deadline was actually detected once the loop ends.
+    # With responses set, presses are being timed, so sleeps stay short.
+    def __init__(self, deadline_ns, responses=False):
+        self.deadline_ns = deadline_ns
+        self.responses = responses
+        self.now_ns = clock_ns()
+        self.event_ns = self.now_ns  # Real clock_ns time the current event was drained
+        self.overshoot_ns = 0
+
+    def __iter__(self):
+        guard_ns = WAIT_GUARD_MS * 1_000_000
+        slice_ns = (WAIT_RESPONSE_SLICE_MS if self.responses else WAIT_SLICE_MS) * 1_000_000
+        while True:
+            self.now_ns = self.event_ns = clock_ns()
+            for event in poll_events():
+                yield event
+            self.now_ns = clock_ns()
+            remaining = self.deadline_ns - self.now_ns
+            if remaining <= 0:
+                break
+            if remaining > guard_ns:
+                time.sleep(min(remaining - guard_ns, slice_ns) / 1e9)
+        self.overshoot_ns = self.now_ns - self.deadline_ns
+
+def ms_to_ns(ms):
+    return int(ms * 1_000_000)
+
+def sleep_until(t_ns):
+    # Same sleep-then-spin as DeadlineWait, for short waits that don't drain events
+    while clock_ns() < t_ns - WAIT_GUARD_MS * 1_000_000:
+        time.sleep(WAIT_GUARD_MS / 2000)
+    while clock_ns() < t_ns:
+        pass
+
+class FrameClock:
+    # Counts presented frames. When FRAME_LOCKED, now_ns() is the presentation
+    # time implied by the flip count, so schedules advance in whole refreshes.
+    def __init__(self):
+        self.period_ns = int(1e9 / FALLBACK_REFRESH_RATE)
+        self.vsynced = False
+        self.count = 0
+        self.last_flip_ns = clock_ns()
+        self.dropped = 0  # Late flips, in missed refreshes
+        self.gap = True   # Next flip doesn't follow the previous frame (block start, pause)
+        self.slot_ns = self.last_flip_ns  # Software refresh grid when flips aren't vsynced
+
+    def measure(self, n_flips=60):
+        # A vsynced flip blocks until the next refresh, so the median interval
+        # between back-to-back flips is the refresh period
+        pygame.display.flip()
+        stamps = []
+        for _ in range(n_flips + 1):
+            pygame.display.flip()
+            stamps.append(clock_ns())
+        period_ns = int(np.median(np.diff(stamps)))
+        self.vsynced = period_ns > 2_000_000
+        if self.vsynced:
+            self.period_ns = period_ns
+        self.last_flip_ns = stamps[-1]
+
+    def flip(self, scheduled_ns=None, rects=None):
+        # scheduled_ns is the schedule point this flip should land on, if any;
+        # rects limits the update to those parts of the window.
+        # A flip arriving more than half a refresh late (i.e. a frame interval
+        # over 1.5x the refresh period) is counted as dropped frames.
+        if FRAME_LOCKED and not self.vsynced:
+            # Nothing to block on, so pace flips to a nominal refresh grid ourselves
+            if self.gap:
+                expected_ns = None
+                self.slot_ns = clock_ns()
+            else:
+                expected_ns = self.slot_ns = self.slot_ns + self.period_ns
+                sleep_until(expected_ns)
+        elif FRAME_LOCKED:
+            expected_ns = None if self.gap else self.last_flip_ns + self.period_ns
+        else:
+            expected_ns = scheduled_ns
+        if rects:
+            pygame.display.update(rects)
+        else:
+            pygame.display.flip()
+        self.last_flip_ns = clock_ns()
+        self.count += 1
+        self.gap = False
+        if expected_ns is not None and self.last_flip_ns - expected_ns > self.period_ns // 2:
+            self.dropped += max(1, round((self.last_flip_ns - expected_ns) / self.period_ns))
+
+    def resync(self):
+        # Call before a flip that follows an idle gap, so it isn't flagged as late
+        self.gap = True
+
+    def real_ns(self, t_ns):
+        # Real clock_ns time of a schedule point
+        if FRAME_LOCKED:
+            return self.last_flip_ns + t_ns - self.now_ns()
+        return t_ns
+
+    def now_ns(self):
+        if FRAME_LOCKED:
+            return self.count * self.period_ns
+        return clock_ns()
+
+    def frames(self, ms):
+        return round(ms_to_ns(ms) / self.period_ns)
+
+    def duration_ns(self, ms):
+        # Requested duration (scalar or array), rounded to whole refreshes when frame-locked
+        if np.ndim(ms):
+            ns = np.asarray(ms, dtype=np.float64) * 1_000_000
+            if FRAME_LOCKED:
+                ns = np.rint(ns / self.period_ns) * self.period_ns
+            return ns.astype(np.int64)
+        if FRAME_LOCKED:
+            return self.frames(ms) * self.period_ns
+        return ms_to_ns(ms)
+
+class FrameWait(DeadlineWait):
+    # Frame-locked counterpart of DeadlineWait: re-present the current frame on
+    # every refresh until the caller's next flip is the one landing on the deadline
+    def __iter__(self):
+        while True:
+            self.now_ns = frame_clock.now_ns()  # Frame time, so pause lengths are measured on the same clock
+            self.event_ns = clock_ns()
+            for event in poll_events():
+                yield event
+            self.now_ns = frame_clock.now_ns()
+            if self.now_ns + frame_clock.period_ns >= self.deadline_ns:
+                break
+            frame_clock.flip()
+        self.now_ns += frame_clock.period_ns  # When the caller's next flip presents
+        self.overshoot_ns = self.now_ns - self.deadline_ns
+
+frame_clock = FrameClock()
+if FRAME_LOCKED:
+    frame_clock.measure()
+    telemetry.log(TELEMETRY_INFO, "Frame-locked mode: {:.2f} Hz ({})", 1e9 / frame_clock.period_ns,
+                  'measured' if frame_clock.vsynced else 'assumed, flips not vsynced')
+TrialWait = FrameWait if FRAME_LOCKED else DeadlineWait
+
+def measure_flip_ns(n_flips=30):
+    # Median time a full-window flip takes to return, including any vsync wait
+    durations = []
+    for _ in range(n_flips):
+        start = clock_ns()
+        pygame.display.flip()
+        durations.append(clock_ns() - start)
+    return int(np.median(durations))
+
+session_settings += [('display_driver', pygame.display.get_driver()),
+                     ('display_mode', f"{WIDTH}x{HEIGHT} {'fullscreen' if FULLSCREEN else 'windowed'}, native {NATIVE_SIZE[0]}x{NATIVE_SIZE[1]}"),
+                     ('pixel_format', f"{screen.get_bitsize()} bpp, masks {'/'.join(f'{m:08x}' for m in screen.get_masks())}"),
+                     ('vsync', DISPLAY_VSYNC),
+                     ('flip_ns', measure_flip_ns())]
+
 # Sounds
-def generate_tone(frequency, duration, volume=0.5):
-    sample_rate = 44100
-    n_samples = int(sample_rate * duration / 1000)
-    t = np.arange(n_samples) / sample_rate
+# Waveform cache: Sounds stay in memory under a small LRU, and the raw int16
+# buffers are saved as .npy so later runs memory-map them instead of synthesizing
+WAVE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wave_cache")
+WAVE_CACHE_SIZE = 16  # Sounds kept in memory
+sound_cache = OrderedDict()
+
+def cached_sound(kind, synthesize, frequency, duration, volume):
+    key = (kind, frequency, duration, volume, SAMPLE_RATE, AUDIO_CHANNELS)
+    if key in sound_cache:
+        sound_cache.move_to_end(key)
+        return sound_cache[key]
+    path = os.path.join(WAVE_CACHE_DIR, f"{kind}_{frequency}_{duration}_{volume}_{SAMPLE_RATE}_{AUDIO_CHANNELS}ch.npy")
+    try:
+        samples = np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        samples = synthesize(frequency, duration, volume)
+        try:
+            os.makedirs(WAVE_CACHE_DIR, exist_ok=True)
+            with open(path + ".tmp", 'wb') as f:
+                np.save(f, samples)
+            os.replace(path + ".tmp", path)  # Never leave a half-written buffer behind
+        except OSError:
+            pass  # Read-only install, the in-memory cache still works
+    sound = sndarray.make_sound(samples)
+    sound_cache[key] = sound
+    if len(sound_cache) > WAVE_CACHE_SIZE:
+        sound_cache.popitem(last=False)
+    return sound
+
+def mixer_layout(tone):
+    # Shape a mono buffer to the mixer's channel count, so make_sound needs no conversion
+    if AUDIO_CHANNELS == 1:
+        return tone
+    return np.repeat(tone[:, np.newaxis], AUDIO_CHANNELS, axis=1)
+
+def synthesize_tone(frequency, duration, volume):
+    n_samples = int(SAMPLE_RATE * duration / 1000)
+    t = np.arange(n_samples) / SAMPLE_RATE
     tone = volume * 32767 * np.sin(2 * math.pi * frequency * t)
     tone = np.clip(tone, -32767, 32767).astype(np.int16)
-    stereo_tone = np.column_stack((tone, tone))
-    sound = sndarray.make_sound(stereo_tone)
-    return sound
+    return mixer_layout(tone)
 
-def generate_chime(duration, base_freq, volume=0.7):
-    sample_rate = 44100
-    n_samples = int(sample_rate * duration / 1000)
-    t = np.arange(n_samples) / sample_rate
+def synthesize_chime(base_freq, duration, volume):
+    n_samples = int(SAMPLE_RATE * duration / 1000)
+    t = np.arange(n_samples) / SAMPLE_RATE
     
     tri_wave = np.abs(np.mod(t * base_freq * 4, 2) - 1)
     tri_wave2 = np.abs(np.mod(t * (base_freq * 2) * 4, 2) - 1)
@@ -75,9 +683,56 @@ def generate_chime(duration, base_freq, volume=0.7):
     tone = volume * 32767 * tone * envelope
     
     tone = np.clip(tone, -32767, 32767).astype(np.int16)
-    stereo_tone = np.column_stack((tone, tone))
-    sound = sndarray.make_sound(stereo_tone)
-    return sound
+    return mixer_layout(tone)
+
+def generate_tone(frequency, duration, volume=0.5):
+    return cached_sound('tone', synthesize_tone, frequency, duration, volume)
+
+def generate_chime(duration, base_freq, volume=0.7):
+    return cached_sound('chime', synthesize_chime, base_freq, duration, volume)
+
+def probe_audio_latency(n_probes=5, probe_ms=10):
+    # pygame can't see the DAC, so this is an estimate: one buffer queued in the
+    # device plus how long the mixer takes to drain a short silent sound beyond
+    # that sound's own length
+    silence = sndarray.make_sound(mixer_layout(np.zeros(int(SAMPLE_RATE * probe_ms / 1000), dtype=np.int16)))
+    overruns = []
+    for _ in range(n_probes):
+        channel = silence.play()
+        start = clock_ns()
+        while channel is not None and channel.get_busy():
+            time.sleep(0.0005)
+        overruns.append(clock_ns() - start - ms_to_ns(probe_ms))
+    return int(AUDIO_BUFFER * 1e9 / SAMPLE_RATE) + max(0, int(np.median(overruns)))
+
+audio_latency_ns = probe_audio_latency()
+session_settings.append(('audio_latency_ns', audio_latency_ns))
+telemetry.log(TELEMETRY_INFO, "Audio: {} Hz, {} ch, buffer {}, estimated output latency {:.1f} ms",
+              SAMPLE_RATE, AUDIO_CHANNELS, AUDIO_BUFFER, audio_latency_ns / 1e6)
+
+# A/V alignment: sounds start av_offset_ns before the stimulus flip (after it if
+# negative) so both reach the participant together. The offset is the station's
+# audio path latency minus its visual path latency, measured with a microphone and
+# photodiode and stored per host in STATION_CALIBRATION_FILE as
+# {"<hostname>": {"av_offset_ms": 23.5}}. Uncalibrated stations use the probe estimate.
+STATION_CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "station_calibration.json")
+
+def load_station_calibration():
+    try:
+        with open(STATION_CALIBRATION_FILE) as f:
+            return json.load(f).get(socket.gethostname(), {})
+    except (OSError, ValueError):
+        return {}
+
+station_calibration = load_station_calibration()
+if 'av_offset_ms' in station_calibration:
+    av_offset_ns = ms_to_ns(station_calibration['av_offset_ms'])
+    av_offset_source = 'station'
+else:
+    av_offset_ns = audio_latency_ns
+    av_offset_source = 'probe'
+    telemetry.log(TELEMETRY_INFO, "No A/V calibration for {}, using the probed audio latency", socket.gethostname())
+session_settings += [('av_offset_ns', av_offset_ns), ('av_offset_source', av_offset_source)]
 
 # Sound definitions
 standard_sound = None
@@ -85,163 +740,473 @@ target_sound = None
 correct_chime = generate_chime(200, 1500)
 incorrect_chime = generate_chime(200, 500)
 
+# Trial timeline: each block is compiled ahead of time into one array of display
+# events with absolute deadlines (ns from block start). Event kinds are bit flags
+# so coinciding changes (diode and stimulus ending together) share one flip.
+# Events are ordered by deadline, so a sound shifted by the A/V offset can fall
+# inside the previous trial's ISI.
+FIXATION_ON, STIM_ON, DIODE_OFF, STIM_OFF, ISI_END, SOUND_ON = 1, 2, 4, 8, 16, 32
+EVENT_NAMES = {FIXATION_ON: 'fixation_on', STIM_ON: 'stim_on', DIODE_OFF: 'diode_off', STIM_OFF: 'stim_off', ISI_END: 'isi_end', SOUND_ON: 'sound_on'}
+
+# Display states an event switches to (NO_CHANGE leaves the screen alone)
+NO_CHANGE, FIXATION, STANDARD_DIODE, STANDARD, TARGET_DIODE, TARGET, BLANK_DIODE, BLANK = range(-1, 7)
+
+TIMELINE_DTYPE = np.dtype([('trial', np.int32), ('kind', np.int8), ('at_ns', np.int64),
+                           ('state', np.int8), ('target', np.bool_), ('sound', np.int8)])
+
+def compile_block_timeline(block_plan):
+    # block_plan is one block of a session plan (see session_plan.py)
+    is_target = np.array(block_plan['target'], dtype=bool)
+    n = len(is_target)
+    visual = STIM_TYPE in ["both", "visual"]
+    audio = STIM_TYPE in ["both", "audio"]
+
+    fix_ns = frame_clock.duration_ns(FIXATION_DURATION) if FIXATION_CROSS else 0
+    stim_ns = frame_clock.duration_ns(STIM_DURATION)
+    pulse_ns = frame_clock.duration_ns(np.array(block_plan['pulse_ms'], dtype=float))
+    isi_ns = frame_clock.duration_ns(np.array(block_plan['isi_ms'], dtype=float))
+    trial_start = np.concatenate(([0], np.cumsum(fix_ns + np.maximum(stim_ns, pulse_ns) + isi_ns)[:-1]))
+    onset = trial_start + fix_ns
+
+    # One row per trial, one column per event slot
+    at = np.stack([trial_start, onset, onset + pulse_ns, onset + stim_ns, onset + np.maximum(stim_ns, pulse_ns) + isi_ns,
+                   onset - av_offset_ns], axis=1)
+    kind = np.tile(np.array([FIXATION_ON, STIM_ON, DIODE_OFF, STIM_OFF, ISI_END, SOUND_ON], dtype=np.int8), (n, 1))
+    state = np.empty((n, 6), dtype=np.int8)
+    state[:, 0] = FIXATION
+    state[:, 1] = np.where(is_target, TARGET_DIODE, STANDARD_DIODE) if visual else BLANK_DIODE
+    state[:, 2] = np.where(visual & (stim_ns > pulse_ns), np.where(is_target, TARGET, STANDARD), BLANK)
+    state[:, 3] = np.where(pulse_ns > stim_ns, BLANK_DIODE, BLANK)
+    state[:, 4:] = NO_CHANGE
+    sound = np.zeros((n, 6), dtype=np.int8)
+    keep = np.ones((n, 6), dtype=bool)
+    # Without an A/V offset the sound rides on the onset flip, played just before it
+    sound_slot = 5 if av_offset_ns else 1
+    if audio:
+        sound[:, sound_slot] = np.where(is_target, 2, 1)
+        kind[:, 1] |= SOUND_ON if sound_slot == 1 else 0
+    keep[:, 5] = audio and sound_slot == 5
+    keep[:, 0] = FIXATION_CROSS
+    # The stimulus offset only changes the display for visual stimuli, and
+    # folds into the diode offset when both end on the same deadline
+    same = pulse_ns == stim_ns
+    kind[same, 2] = DIODE_OFF | STIM_OFF
+    keep[:, 3] = visual & ~same
+
+    trial = np.repeat(np.arange(n), 6).reshape(n, 6)
+    slot = np.tile(np.arange(6), (n, 1))
+    order = np.lexsort((slot[keep], trial[keep], at[keep]))
+    timeline = np.empty(order.size, dtype=TIMELINE_DTYPE)
+    timeline['trial'] = trial[keep][order]
+    timeline['kind'] = kind[keep][order]
+    timeline['at_ns'] = at[keep][order]
+    timeline['state'] = state[keep][order]
+    timeline['target'] = is_target[trial[keep][order]]
+    timeline['sound'] = sound[keep][order]
+    return timeline
+
+def size_px(size):
+    # Pixels for a (degrees, fraction of height) size, see STIMULUS_SIZE
+    degrees, fraction = size
+    if VIEWING_DISTANCE_CM and SCREEN_WIDTH_CM:
+        cm = 2 * VIEWING_DISTANCE_CM * math.tan(math.radians(degrees / 2))
+        return max(1, round(cm * NATIVE_SIZE[0] / SCREEN_WIDTH_CM))
+    return max(1, round(fraction * HEIGHT))
+
+def generate_spiky_star(center_x, center_y, outer_radius, inner_radius, num_spikes):
+    points = []
+    angle_step = 2 * math.pi / (num_spikes * 2)
+    for i in range(num_spikes * 2):
+        angle = i * angle_step
+        radius = outer_radius if i % 2 == 0 else inner_radius
+        x = center_x + radius * math.cos(angle)
+        y = center_y + radius * math.sin(angle)
+        points.append((x, y))
+    return points
+
+def draw_shape(surface, shape, colour, half):
+    # Stimulus shape centred in the window, half its size across
+    if shape == "circle":
+        pygame.draw.circle(surface, colour, (WIDTH // 2, HEIGHT // 2), half)
+    elif shape == "triangle":
+        pygame.draw.polygon(surface, colour, 
+                           [(WIDTH // 2, HEIGHT // 2 - half), 
+                            (WIDTH // 2 - half, HEIGHT // 2 + half), 
+                            (WIDTH // 2 + half, HEIGHT // 2 + half)])
+    elif shape == "star":  # oddball4's star: 12 spikes, twice the circle's radius out and half of it in
+        pygame.draw.polygon(surface, colour, generate_spiky_star(WIDTH // 2, HEIGHT // 2, 2 * half, half // 2, 12))
+
+def render_state(surface, state):
+    half = size_px(STIMULUS_SIZE) // 2
+    arm = size_px(FIXATION_SIZE) // 2
+    surface.fill(BLACK)
+    if state == FIXATION:
+        line_width = size_px(FIXATION_WIDTH)
+        pygame.draw.line(surface, WHITE, (WIDTH // 2 - arm, HEIGHT // 2), (WIDTH // 2 + arm, HEIGHT // 2), line_width)  # Horizontal
+        pygame.draw.line(surface, WHITE, (WIDTH // 2, HEIGHT // 2 - arm), (WIDTH // 2, HEIGHT // 2 + arm), line_width)  # Vertical
+    elif state in (STANDARD_DIODE, STANDARD):
+        draw_shape(surface, stimulus_shapes[0], RED, half)
+    elif state in (TARGET_DIODE, TARGET):
+        draw_shape(surface, stimulus_shapes[1], GREEN, half)
+    # Photo sensor square, white while the diode pulse is on
+    pygame.draw.rect(surface, WHITE if state in (STANDARD_DIODE, TARGET_DIODE, BLANK_DIODE) else BLACK, 
+                     (WIDTH - SQUARE_SIZE - 10, HEIGHT - SQUARE_SIZE - 10, SQUARE_SIZE, SQUARE_SIZE))
+
+# Frame cache: every display state pre-rendered once in the display's pixel
+# format, so a transition is a single blit. Each block rebuilds it if the window
+# has changed size since, on any screen.
+# dirty_rects holds, per (from, to) pair, the regions that differ between the two
+# frames, so most transitions (e.g. the diode turning off) only touch those.
+frame_cache = {}
+dirty_rects = {}
+stimulus_shapes = SHAPES  # Standard and target shape the cache was built with
+frame_cache_size = None  # Window size the cache was built at
+
+def state_regions():
+    # Parts of the window render_state can change: the stimulus and the diode square
+    stimulus = size_px(STIMULUS_SIZE) * (2 if "star" in stimulus_shapes else 1)
+    half = max(stimulus, size_px(FIXATION_SIZE) + size_px(FIXATION_WIDTH)) // 2 + 1
+    return [pygame.Rect(WIDTH // 2 - half, HEIGHT // 2 - half, 2 * half + 1, 2 * half + 1),
+            pygame.Rect(WIDTH - SQUARE_SIZE - 10, HEIGHT - SQUARE_SIZE - 10, SQUARE_SIZE, SQUARE_SIZE)]
+
+def build_frame_cache():
+    global frame_cache_size
+    start = clock_ns()
+    frame_cache_size = (WIDTH, HEIGHT)
+    states = range(FIXATION, BLANK + 1)
+    for state in states:
+        frame_cache[state] = pygame.Surface((WIDTH, HEIGHT)).convert(screen)
+        render_state(frame_cache[state], state)
+    regions = [r.clip(screen.get_rect()) for r in state_regions()]
+    pixels = {(state, i): pygame.image.tobytes(frame_cache[state].subsurface(r), 'RGB')
+              for state in states for i, r in enumerate(regions)}
+    for old in states:
+        for new in states:
+            dirty_rects[old, new] = [r for i, r in enumerate(regions) if pixels[old, i] != pixels[new, i]]
+    return clock_ns() - start
+
+# Block conditions: modality, tones and shapes. Counterbalanced cohorts give each
+# block its own (see cohort_plan.py); otherwise every block uses the menu's modality
+# with TONES and SHAPES.
+SHAPE_NAMES = {"circle": "circle", "triangle": "triangle", "star": "spiky star"}
+
+def apply_condition(condition):
+    # Make condition current for compiling and running a block
+    global STIM_TYPE, standard_sound, target_sound, stimulus_shapes
+    STIM_TYPE = condition['stim_type']
+    standard_sound, target_sound = (generate_tone(frequency, STIM_DURATION) for frequency in condition['tones'])
+    if tuple(condition['shapes']) != stimulus_shapes:
+        stimulus_shapes = tuple(condition['shapes'])
+        build_frame_cache()
+
+def instruction_text(condition):
+    # What the participant responds to under condition
+    shape = SHAPE_NAMES[condition['shapes'][1]]
+    pitch = "high" if condition['tones'][1] > condition['tones'][0] else "low"
+    if condition['stim_type'] == "both":
+        return f"when the green {shape} or {pitch} tone occurs"
+    elif condition['stim_type'] == "audio":
+        return f"when you hear the {pitch} tone"
+    return f"when the green {shape} is displayed"
+
+def draw_state(state):
+    screen.blit(frame_cache[state], (0, 0))
+
+def draw_transition(old, new):
+    # Copy only what changes from old to new; returns the rects to update
+    rects = dirty_rects[old, new]
+    for rect in rects:
+        screen.blit(frame_cache[new], rect, rect)
+    return rects
+
 # Fonts (scaled for default size, will adjust dynamically)
 title_font = pygame.font.SysFont("Arial", 50, bold=True)
 prompt_font = pygame.font.SysFont("Arial", 28, bold=True)
 info_font = pygame.font.SysFont("Arial", 24)
 countdown_font = pygame.font.SysFont("Arial", 80, bold=True)
 
-# Main loop
-while True:
-    # Get user name
-    screen.fill(DARK_GRAY)
-    title_text = title_font.render("Welcome", True, CYAN)
-    name_prompt = prompt_font.render("Enter your name:", True, WHITE)
-    user_name = ""
-    entering_name = True
-    while entering_name:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                exit()
-            if event.type == pygame.VIDEORESIZE:
-                WIDTH, HEIGHT = event.w, event.h
-                screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_RETURN and user_name:
-                    entering_name = False
-                elif event.key == pygame.K_BACKSPACE:
-                    user_name = user_name[:-1]
-                elif event.unicode.isalnum():
-                    user_name += event.unicode
-        
+# Text surfaces: rendered strings are kept in an LRU keyed by (font, text, colour),
+# so a repaint only rasterizes the text that changed, e.g. the field being edited
+TEXT_CACHE_SIZE = 128
+text_cache = OrderedDict()
+
+def render_text(font, text, colour):
+    key = (font, text, colour)
+    if key in text_cache:
+        text_cache.move_to_end(key)
+        return text_cache[key]
+    surface = font.render(text, True, colour)
+    text_cache[key] = surface
+    if len(text_cache) > TEXT_CACHE_SIZE:
+        text_cache.popitem(last=False)
+    return surface
+
+# Menu screens are retained-mode: each screen keeps its own state, draw() paints
+# it and handle() updates it from one event, returning True when that needs a
+# repaint. run() blocks on pygame.event.wait and only repaints after input or a
+# resize, at most MENU_MAX_FPS times a second, so an idle station stays cool.
+MENU_MAX_FPS = 30
+MENU_WAIT_MS = 1000  # event.wait timeout, so a quiet screen still wakes up now and then
+menu_clock = pygame.time.Clock()
+
+class Screen:
+    def __init__(self):
+        self.done = False
+
+    def layout(self):
+        pass  # Recompute anything positioned from WIDTH and HEIGHT
+
+    def draw(self):
+        raise NotImplementedError
+
+    def handle(self, event):
+        return False
+
+    def run(self):
+        global screen, WIDTH, HEIGHT
+        self.layout()
+        cpu_start, wall_start = time.process_time_ns(), clock_ns()
+        dirty = True
+        while not self.done:
+            if dirty:
+                self.draw()
+                pygame.display.flip()
+                menu_clock.tick(MENU_MAX_FPS)
+                dirty = False
+            event = pygame.event.wait(MENU_WAIT_MS)
+            if event.type == pygame.NOEVENT:
+                continue
+            for event in [event] + pygame.event.get():
+                if event.type == pygame.QUIT:
+                    if session_log is not None:
+                        session_log.close('aborted')
+                    pygame.quit()
+                    exit()
+                if event.type == pygame.VIDEORESIZE:
+                    WIDTH, HEIGHT = event.w, event.h
+                    screen = pygame.display.set_mode((WIDTH, HEIGHT), DISPLAY_FLAGS, vsync=DISPLAY_VSYNC)
+                    self.layout()
+                    dirty = True
+                dirty = self.handle(event) or dirty
+                if self.done:
+                    break
+        # Idle check: CPU time the whole process used while this screen was up
+        wall_ns = clock_ns() - wall_start
+        telemetry.log(TELEMETRY_DEBUG, "{}: {:.1f}% CPU over {:.1f} s", type(self).__name__,
+                      100 * (time.process_time_ns() - cpu_start) / wall_ns, wall_ns / 1e9)
+        return self
+
+class NameScreen(Screen):
+    def __init__(self):
+        super().__init__()
+        self.user_name = ""
+
+    def handle(self, event):
+        if event.type != pygame.KEYDOWN:
+            return False
+        if event.key == pygame.K_RETURN and self.user_name:
+            self.done = True
+        elif event.key == pygame.K_BACKSPACE:
+            self.user_name = self.user_name[:-1]
+        elif event.unicode.isalnum():
+            self.user_name += event.unicode
+        return True
+
+    def draw(self):
+        title_text = render_text(title_font, "Welcome", CYAN)
+        name_prompt = render_text(prompt_font, "Enter your name:", WHITE)
         screen.fill(DARK_GRAY)
         total_height = title_text.get_height() + name_prompt.get_height() + info_font.get_height() + 40
         start_y = (HEIGHT - total_height) // 2
         screen.blit(title_text, (WIDTH // 2 - title_text.get_width() // 2, start_y))
         screen.blit(name_prompt, (WIDTH // 2 - name_prompt.get_width() // 2, start_y + title_text.get_height() + 20))
-        name_text = info_font.render(user_name + "|", True, WHITE)
+        name_text = render_text(info_font, self.user_name + "|", WHITE)
         screen.blit(name_text, (WIDTH // 2 - name_text.get_width() // 2, start_y + title_text.get_height() + name_prompt.get_height() + 40))
-        pygame.display.flip()
 
-    # Parameter input screen with checkbox and radio buttons
-    parameters = [
-        ("Trials per block", str(TOTAL_TRIALS)),
-        ("Stimulus duration (ms)", str(STIM_DURATION)),
-        ("Inter-stimulus interval (ms)", str(ISI)),
-        ("Number of blocks", str(NUM_BLOCKS)),
-        ("Fixation duration (ms)", str(FIXATION_DURATION)),
-        ("Diode pulse length (target, ms)", str(TARGET_PULSE)),  # Added
-        ("Diode pulse length (non-target, ms)", str(STANDARD_PULSE))  # Added
-    ]
-    param_values = [pair[1] for pair in parameters]
-    active_param = 0
-    isi_varies = ISI_VARIES
-    stim_type = STIM_TYPE
-    fixation_cross = FIXATION_CROSS  # Default to True
-    entering_params = True
-
-    input_boxes = []
+class ParamScreen(Screen):
+    # Parameter input screen with checkbox, radio buttons and an ISI distribution
+    # selector (click it, or use left/right while the ISI box is active)
     box_width, box_height = 200, 40
     start_y = 150
     spacing = 70
-    for i in range(len(parameters)):
-        y_pos = start_y + i * spacing
-        input_boxes.append(pygame.Rect(WIDTH // 2 - box_width // 2, y_pos + 30, box_width, box_height))
-    
-    checkbox_rect_isi = pygame.Rect(WIDTH // 2 + box_width // 2 + 10, start_y + 2 * spacing + 30, 20, 20)
-    checkbox_rect_fixation = pygame.Rect(WIDTH // 2 + box_width // 2 + 10, start_y + 4 * spacing + 30, 20, 20)  # New checkbox for fixation
-    radio_rects = [
-        pygame.Rect(WIDTH // 2 - 150, start_y + 7 * spacing + 30, 20, 20),  # Both
-        pygame.Rect(WIDTH // 2 - 50, start_y + 7 * spacing + 30, 20, 20),   # Audio
-        pygame.Rect(WIDTH // 2 + 50, start_y + 7 * spacing + 30, 20, 20)    # Visual
-    ]
-
-    while entering_params:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                exit()
-            if event.type == pygame.VIDEORESIZE:
-                WIDTH, HEIGHT = event.w, event.h
-                screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
-                # Recalculate positions
-                input_boxes = []
-                for i in range(len(parameters)):
-                    y_pos = start_y + i * spacing
-                    input_boxes.append(pygame.Rect(WIDTH // 2 - box_width // 2, y_pos + 30, box_width, box_height))
-                checkbox_rect_isi = pygame.Rect(WIDTH // 2 + box_width // 2 + 10, start_y + 2 * spacing + 30, 20, 20)
-                checkbox_rect_fixation = pygame.Rect(WIDTH // 2 + box_width // 2 + 10, start_y + 4 * spacing + 30, 20, 20)
-                radio_rects = [
-                    pygame.Rect(WIDTH // 2 - 150, start_y + 7 * spacing + 30, 20, 20),
-                    pygame.Rect(WIDTH // 2 - 50, start_y + 7 * spacing + 30, 20, 20),
-                    pygame.Rect(WIDTH // 2 + 50, start_y + 7 * spacing + 30, 20, 20)
-                ]
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                for i, box in enumerate(input_boxes):
-                    if box.collidepoint(event.pos):
-                        active_param = i
-                if checkbox_rect_isi.collidepoint(event.pos):
-                    isi_varies = not isi_varies
-                if checkbox_rect_fixation.collidepoint(event.pos):
-                    fixation_cross = not fixation_cross
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_TAB:
-                    active_param = (active_param + 1) % len(parameters)
-                elif event.key == pygame.K_RETURN and all(param_values):
-                    entering_params = False
-                elif event.key == pygame.K_BACKSPACE:
-                    param_values[active_param] = param_values[active_param][:-1]
-                elif event.unicode.isdigit():
-                    param_values[active_param] += event.unicode
 
+    def __init__(self):
+        super().__init__()
+        self.parameters = [
+            ("Trials per block", str(TOTAL_TRIALS)),
+            ("Stimulus duration (ms)", str(STIM_DURATION)),
+            ("Inter-stimulus interval (ms)", str(ISI)),
+            ("Number of blocks", str(NUM_BLOCKS)),
+            ("Fixation duration (ms)", str(FIXATION_DURATION)),
+            ("Diode pulse length (target, ms)", str(TARGET_PULSE)),  # Added
+            ("Diode pulse length (non-target, ms)", str(STANDARD_PULSE))  # Added
+        ]
+        self.param_values = [pair[1] for pair in self.parameters]
+        self.active_param = 0
+        self.isi_distribution = ISI_DISTRIBUTION
+        self.stim_type = STIM_TYPE
+        self.fixation_cross = FIXATION_CROSS  # Default to True
+
+    def layout(self):
+        box_width, start_y, spacing = self.box_width, self.start_y, self.spacing
+        self.input_boxes = [pygame.Rect(WIDTH // 2 - box_width // 2, start_y + i * spacing + 30, box_width, self.box_height)
+                            for i in range(len(self.parameters))]
+        self.selector_rect_isi = pygame.Rect(WIDTH // 2 + box_width // 2 + 10, start_y + 2 * spacing + 30, 160, 26)
+        self.checkbox_rect_fixation = pygame.Rect(WIDTH // 2 + box_width // 2 + 10, start_y + 4 * spacing + 30, 20, 20)
+        self.radio_rects = [
+            pygame.Rect(WIDTH // 2 - 150, start_y + 7 * spacing + 30, 20, 20),  # Both
+            pygame.Rect(WIDTH // 2 - 50, start_y + 7 * spacing + 30, 20, 20),   # Audio
+            pygame.Rect(WIDTH // 2 + 50, start_y + 7 * spacing + 30, 20, 20)    # Visual
+        ]
+
+    def handle(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            for i, box in enumerate(self.input_boxes):
+                if box.collidepoint(event.pos):
+                    self.active_param = i
+            if self.selector_rect_isi.collidepoint(event.pos):
+                self.next_isi_distribution(1)
+            if self.checkbox_rect_fixation.collidepoint(event.pos):
+                self.fixation_cross = not self.fixation_cross
+            return True
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_TAB:
+                self.active_param = (self.active_param + 1) % len(self.parameters)
+            elif event.key == pygame.K_RETURN and all(self.param_values):
+                self.done = True
+            elif event.key == pygame.K_BACKSPACE:
+                self.param_values[self.active_param] = self.param_values[self.active_param][:-1]
+            elif event.key in (pygame.K_LEFT, pygame.K_RIGHT) and self.active_param == 2:
+                self.next_isi_distribution(1 if event.key == pygame.K_RIGHT else -1)
+            elif event.unicode.isdigit():
+                self.param_values[self.active_param] += event.unicode
+            return True
+        return False
+
+    def next_isi_distribution(self, step):
+        names = list(ISI_DISTRIBUTIONS)
+        self.isi_distribution = names[(names.index(self.isi_distribution) + step) % len(names)]
+
+    def draw(self):
+        start_y, spacing, active_param = self.start_y, self.spacing, self.active_param
         screen.fill(DARK_GRAY)
         pygame.draw.rect(screen, BLACK, (WIDTH // 4, 50, WIDTH // 2, HEIGHT - 100), 5)
+        title_text = render_text(title_font, "Welcome", CYAN)
         screen.blit(title_text, (WIDTH // 2 - title_text.get_width() // 2, 60))
 
-        for i, (param_name, _) in enumerate(parameters):
-            param_text = prompt_font.render(f"{param_name}", True, WHITE)
+        for i, (param_name, _) in enumerate(self.parameters):
+            if i == 2 and self.isi_distribution == "fixed_soa":
+                param_name = "Stimulus onset asynchrony (ms)"
+            param_text = render_text(prompt_font, f"{param_name}", WHITE)
             screen.blit(param_text, (WIDTH // 2 - param_text.get_width() // 2, start_y + i * spacing))
-            input_value = param_values[i] + ("|" if i == active_param else "")
-            input_text = info_font.render(input_value, True, WHITE)
-            input_rect = input_boxes[i]
+            input_value = self.param_values[i] + ("|" if i == active_param else "")
+            input_text = render_text(info_font, input_value, WHITE)
+            input_rect = self.input_boxes[i]
             pygame.draw.rect(screen, CYAN if i == active_param else WHITE, input_rect, 3)
-            screen.blit(input_text, (input_rect.x + 10, input_rect.y + (box_height - input_text.get_height()) // 2))
-        
-        # ISI variation checkbox
-        pygame.draw.rect(screen, WHITE if active_param != 2 else CYAN, checkbox_rect_isi, 2)
-        if isi_varies:
-            pygame.draw.line(screen, WHITE, (checkbox_rect_isi.x + 4, checkbox_rect_isi.y + 10), 
-                            (checkbox_rect_isi.x + 10, checkbox_rect_isi.y + 16), 2)
-            pygame.draw.line(screen, WHITE, (checkbox_rect_isi.x + 10, checkbox_rect_isi.y + 16), 
-                            (checkbox_rect_isi.x + 16, checkbox_rect_isi.y + 4), 2)
-        varies_text = info_font.render("500ms variation", True, WHITE)
-        screen.blit(varies_text, (checkbox_rect_isi.x + 25, checkbox_rect_isi.y - 5))
+            screen.blit(input_text, (input_rect.x + 10, input_rect.y + (self.box_height - input_text.get_height()) // 2))
+
+        # ISI distribution selector
+        selector_rect_isi = self.selector_rect_isi
+        pygame.draw.rect(screen, WHITE if active_param != 2 else CYAN, selector_rect_isi, 2)
+        distribution_text = render_text(info_font, f"< {self.isi_distribution} >", WHITE)
+        screen.blit(distribution_text, (selector_rect_isi.centerx - distribution_text.get_width() // 2,
+                                        selector_rect_isi.centery - distribution_text.get_height() // 2))
 
         # Fixation cross checkbox
+        checkbox_rect_fixation = self.checkbox_rect_fixation
         pygame.draw.rect(screen, WHITE if active_param != 4 else CYAN, checkbox_rect_fixation, 2)
-        if fixation_cross:
+        if self.fixation_cross:
             pygame.draw.line(screen, WHITE, (checkbox_rect_fixation.x + 4, checkbox_rect_fixation.y + 10), 
                             (checkbox_rect_fixation.x + 10, checkbox_rect_fixation.y + 16), 2)
             pygame.draw.line(screen, WHITE, (checkbox_rect_fixation.x + 10, checkbox_rect_fixation.y + 16), 
                             (checkbox_rect_fixation.x + 16, checkbox_rect_fixation.y + 4), 2)
-        fixation_text = info_font.render("Fixation cross?", True, WHITE)
+        fixation_text = render_text(info_font, "Fixation cross?", WHITE)
         screen.blit(fixation_text, (checkbox_rect_fixation.x + 25, checkbox_rect_fixation.y - 5))
 
         # Stimulus type radio buttons
-        stim_type_text = prompt_font.render("Stimuli Type:", True, WHITE)
+        stim_type_text = render_text(prompt_font, "Stimuli Type:", WHITE)
         screen.blit(stim_type_text, (WIDTH // 2 - stim_type_text.get_width() // 2, start_y + 7 * spacing))
         modes = ["Both", "Audio", "Visual"]
-        for i, rect in enumerate(radio_rects):
+        for i, rect in enumerate(self.radio_rects):
             pygame.draw.circle(screen, WHITE, rect.center, 10, 2)
-            if stim_type == ["both", "audio", "visual"][i]:
+            if self.stim_type == ["both", "audio", "visual"][i]:
                 pygame.draw.circle(screen, CYAN, rect.center, 6)
-            mode_text = info_font.render(modes[i], True, WHITE)
+            mode_text = render_text(info_font, modes[i], WHITE)
             screen.blit(mode_text, (rect.x + 25, rect.y - 5))
 
-        instruction_text = info_font.render("Press Enter to continue", True, WHITE)
+        instruction_text = render_text(info_font, "Press Enter to continue", WHITE)
         screen.blit(instruction_text, (WIDTH // 2 - instruction_text.get_width() // 2, start_y + 8 * spacing + 20))
-        pygame.display.flip()
+
+class MessageScreen(Screen):
+    # Boxed message, lines given as (font, text, colour, y offset from the centre).
+    # Closes on any key, or only on one of keys if given.
+    def __init__(self, lines, title=False, keys=None):
+        super().__init__()
+        self.lines = lines
+        self.title = title
+        self.keys = keys
+
+    def handle(self, event):
+        if event.type == pygame.KEYDOWN and (self.keys is None or event.key in self.keys):
+            self.done = True
+        return False
+
+    def draw(self):
+        screen.fill(DARK_GRAY)
+        pygame.draw.rect(screen, BLACK, (WIDTH // 4, HEIGHT // 4, WIDTH // 2, HEIGHT // 2), 5)
+        if self.title:
+            title_text = render_text(title_font, "Welcome", CYAN)
+            screen.blit(title_text, (WIDTH // 2 - title_text.get_width() // 2, HEIGHT // 4 + 20))
+        for font, text, colour, dy in self.lines:
+            line_text = render_text(font, text, colour)
+            screen.blit(line_text, (WIDTH // 2 - line_text.get_width() // 2, HEIGHT // 2 + dy))
+
+class TargetCountScreen(Screen):
+    # Ask participant how many targets they saw at the end of each block
+    def __init__(self, block_num):
+        super().__init__()
+        self.block_num = block_num
+        self.target_count = ""
+
+    def handle(self, event):
+        if event.type != pygame.KEYDOWN:
+            return False
+        if event.key == pygame.K_RETURN and self.target_count:
+            self.done = True
+        elif event.key == pygame.K_BACKSPACE:
+            self.target_count = self.target_count[:-1]
+        elif event.unicode.isdigit():
+            self.target_count += event.unicode
+        return True
+
+    def draw(self):
+        screen.fill(DARK_GRAY)
+        pygame.draw.rect(screen, BLACK, (WIDTH // 4, HEIGHT // 4, WIDTH // 2, HEIGHT // 2), 5)
+        prompt_text1 = render_text(prompt_font, f"Block {self.block_num} finished", WHITE)
+        prompt_text2 = render_text(prompt_font, "How many targets did you see?", WHITE)
+        prompt_text3 = render_text(info_font, self.target_count + "|", WHITE)
+        prompt_text4 = render_text(info_font, "Press Enter to continue", CYAN)
+        screen.blit(prompt_text1, (WIDTH // 2 - prompt_text1.get_width() // 2, HEIGHT // 2 - 80))
+        screen.blit(prompt_text2, (WIDTH // 2 - prompt_text2.get_width() // 2, HEIGHT // 2 - 30))
+        screen.blit(prompt_text3, (WIDTH // 2 - prompt_text3.get_width() // 2, HEIGHT // 2 + 20))
+        screen.blit(prompt_text4, (WIDTH // 2 - prompt_text4.get_width() // 2, HEIGHT // 2 + 70))
+
+# Main loop
+session_log = None  # The current session's log; closing the window from any screen closes it as aborted
+while True:
+    # Get user name
+    user_name = autorun["user_name"] if autorun else NameScreen().run().user_name
+
+    param_screen = ParamScreen()
+    if autorun:
+        param_screen.param_values = [str(autorun.get(key, value)) for key, value in zip(AUTORUN_PARAMS, param_screen.param_values)]
+        param_screen.isi_distribution = autorun.get("isi_distribution", param_screen.isi_distribution)
+        param_screen.stim_type = autorun.get("stim_type", param_screen.stim_type)
+        param_screen.fixation_cross = autorun.get("fixation_cross", param_screen.fixation_cross)
+    else:
+        param_screen.run()
+    param_values = param_screen.param_values
+    fixation_cross = param_screen.fixation_cross
 
     # Convert parameters
     TOTAL_TRIALS = int(param_values[0])
@@ -251,54 +1216,91 @@ while True:
     FIXATION_DURATION = int(param_values[4]) if fixation_cross else 0  # Use 0 if fixation is off
     TARGET_PULSE = int(param_values[5])  # Added
     STANDARD_PULSE = int(param_values[6])  # Added
-    ISI_VARIES = isi_varies
-    STIM_TYPE = stim_type
+    ISI_DISTRIBUTION = param_screen.isi_distribution
+    STIM_TYPE = param_screen.stim_type
     FIXATION_CROSS = fixation_cross
 
-    # Generate stimulus sounds
-    standard_sound = generate_tone(1000, STIM_DURATION)
-    target_sound = generate_tone(1500, STIM_DURATION)
+    # The participant's counterbalanced conditions replace the menu's modality. A
+    # within-participant block order only stays balanced if the session runs it
+    # whole, so the blocks repeat it a whole number of times
+    base_condition = {'stim_type': STIM_TYPE, 'tones': TONES, 'shapes': SHAPES}
+    cohort = load_cohort_settings(COHORT_SETTINGS_DIR, user_name)
+    conditions = [dict(base_condition, **condition) for condition in cohort['blocks']] if cohort else [base_condition]
+    if cohort:
+        telemetry.log(TELEMETRY_INFO, "Cohort cell {}: {}", cohort['cell'], cohort['levels'])
+
+    # Trial order, ISIs and pulse lengths come from the participant's pre-generated
+    # plan, whose values override the menu's; otherwise a plan is drawn now from a
+    # fresh seed. Either way the plan is saved with the session log.
+    plan = load_plan(SESSION_PLAN_DIR, user_name)
+    if plan is not None and len(plan['blocks']) % len(conditions):
+        if autorun:
+            raise ValueError(f"Plan has {len(plan['blocks'])} blocks, cohort order has {len(conditions)}")
+        MessageScreen([(prompt_font, "Plan and cohort don't match", WHITE, -50),
+                       (info_font, f"The plan's {len(plan['blocks'])} block(s) don't repeat the cohort's {len(conditions)}-block order whole", WHITE, 0),
+                       (info_font, "Press any key to go back", CYAN, 50)]).run()
+        continue
+    if plan is not None:
+        plan_source = plan_path(SESSION_PLAN_DIR, user_name)
+        planned = plan['parameters']
+        TOTAL_TRIALS, NUM_BLOCKS = len(plan['blocks'][0]['target']), len(plan['blocks'])
+        STIM_DURATION, FIXATION_DURATION = planned['stim_duration'], planned['fixation_duration']
+        BASE_ISI, ISI_DISTRIBUTION = planned['isi'], planned['isi_distribution']
+        TARGET_PULSE, STANDARD_PULSE = planned['target_pulse'], planned['standard_pulse']
+        FIXATION_CROSS = FIXATION_DURATION > 0
+        param_values[:] = [str(v) for v in (TOTAL_TRIALS, STIM_DURATION, BASE_ISI, NUM_BLOCKS, FIXATION_DURATION, TARGET_PULSE, STANDARD_PULSE)]
+        telemetry.log(TELEMETRY_INFO, "Loaded session plan {} (seed {})", plan_source, plan['seed'])
+    else:
+        plan_source = 'runtime'
+        if NUM_BLOCKS % len(conditions):
+            blocks = -(-NUM_BLOCKS // len(conditions)) * len(conditions)
+            telemetry.log(TELEMETRY_INFO, "Running {} blocks instead of {} to complete the cohort's {}-block order", blocks, NUM_BLOCKS, len(conditions))
+            NUM_BLOCKS = blocks
+            param_values[3] = str(NUM_BLOCKS)
+        try:
+            plan = make_plan(user_name, trials=TOTAL_TRIALS, blocks=NUM_BLOCKS, target_prob=TARGET_PROB, stim_duration=STIM_DURATION,
+                             fixation_duration=FIXATION_DURATION, isi=BASE_ISI, isi_distribution=ISI_DISTRIBUTION, isi_spread=ISI_SPREAD,
+                             isi_scale=ISI_SCALE, isi_values=ISI_VALUES, target_pulse=TARGET_PULSE, standard_pulse=STANDARD_PULSE,
+                             leading_standards=LEADING_STANDARDS, min_standards_between_targets=MIN_STANDARDS_BETWEEN_TARGETS,
+                             max_run_length=MAX_RUN_LENGTH)
+        except ValueError as e:
+            # No sequence or ISIs fit these settings, e.g. an SOA shorter than fixation plus stimulus
+            if autorun:
+                raise
+            MessageScreen([(prompt_font, "These settings can't be run", WHITE, -50),
+                           (info_font, str(e), WHITE, 0),
+                           (info_font, "Press any key to go back", CYAN, 50)]).run()
+            continue
+    for block, block_plan in enumerate(plan['blocks'], 1):
+        stats = block_plan['isi_stats']
+        telemetry.log(TELEMETRY_INFO, "Block {} ISIs ({}): mean {:.1f} ms, SD {:.1f} ms, range {:.1f}-{:.1f} ms; distribution mean {:.1f} ms, SD {:.1f} ms",
+                      block, ISI_DISTRIBUTION, stats['drawn_mean'], stats['drawn_sd'], stats['drawn_min'], stats['drawn_max'], stats['mean'], stats['sd'])
 
-    print("Testing correct chime...")
-    correct_chime.play()
-    pygame.time.wait(250)
+    block_conditions = [conditions[i % len(conditions)] for i in range(NUM_BLOCKS)]
+
+    if autorun is None:  # Would land in the harness's recording as a stray onset
+        telemetry.log(TELEMETRY_DEBUG, "Testing correct chime...")
+        correct_chime.play()
+        pygame.time.wait(250)
 
     # Instruction screen
-    screen.fill(DARK_GRAY)
-    pygame.draw.rect(screen, BLACK, (WIDTH // 4, HEIGHT // 4, WIDTH // 2, HEIGHT // 2), 5)
-    screen.blit(title_text, (WIDTH // 2 - title_text.get_width() // 2, HEIGHT // 4 + 20))
-    if STIM_TYPE == "both":
-        instruction_text1 = prompt_font.render(f"{user_name}, press the spacebar", True, WHITE)
-        instruction_text2 = prompt_font.render("when the green triangle or high tone occurs", True, WHITE)
-    elif STIM_TYPE == "audio":
-        instruction_text1 = prompt_font.render(f"{user_name}, press the spacebar", True, WHITE)
-        instruction_text2 = prompt_font.render("when you hear the high tone", True, WHITE)
-    else:  # visual
-        instruction_text1 = prompt_font.render(f"{user_name}, press the spacebar", True, WHITE)
-        instruction_text2 = prompt_font.render("when the green triangle is displayed", True, WHITE)
-    instruction_text3 = info_font.render("Press any key to start", True, CYAN)
-    screen.blit(instruction_text1, (WIDTH // 2 - instruction_text1.get_width() // 2, HEIGHT // 2 - 50))
-    screen.blit(instruction_text2, (WIDTH // 2 - instruction_text2.get_width() // 2, HEIGHT // 2))
-    screen.blit(instruction_text3, (WIDTH // 2 - instruction_text3.get_width() // 2, HEIGHT // 2 + 60))
-    pygame.display.flip()
-
-    waiting = True
-    while waiting:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                exit()
-            if event.type == pygame.VIDEORESIZE:
-                WIDTH, HEIGHT = event.w, event.h
-                screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
-            if event.type == pygame.KEYDOWN:
-                waiting = False
+    if autorun is None:
+        MessageScreen([(prompt_font, f"{user_name}, press the spacebar", WHITE, -50),
+                       (prompt_font, instruction_text(block_conditions[0]), WHITE, 0),
+                       (info_font, "Press any key to start", CYAN, 60)], title=True).run()
+
+    # Compile every block's timeline before the countdown, so the trial loop
+    # only has to walk precomputed deadlines
+    timelines = []
+    for block_plan, condition in zip(plan['blocks'], block_conditions):
+        apply_condition(condition)
+        timelines.append(compile_block_timeline(block_plan))
 
     # Countdown
-    for count in ["3", "2", "1", "GO!"]:
+    for count in [] if autorun else ["3", "2", "1", "GO!"]:
         screen.fill(DARK_GRAY)
         pygame.draw.rect(screen, BLACK, (WIDTH // 4, HEIGHT // 4, WIDTH // 2, HEIGHT // 2), 5)
-        count_text = countdown_font.render(count, True, CYAN)
+        count_text = render_text(countdown_font, count, CYAN)
         screen.blit(count_text, (WIDTH // 2 - count_text.get_width() // 2, HEIGHT // 2 - count_text.get_height() // 2))
         pygame.display.flip()
         pygame.time.wait(1000)
@@ -308,322 +1310,256 @@ while True:
                 exit()
             if event.type == pygame.VIDEORESIZE:
                 WIDTH, HEIGHT = event.w, event.h
-                screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
+                screen = pygame.display.set_mode((WIDTH, HEIGHT), DISPLAY_FLAGS, vsync=DISPLAY_VSYNC)
 
     # Main experiment loop
-    all_logs = []
+    telemetry.log(TELEMETRY_DEBUG, "Frame cache built in {:.1f} ms", build_frame_cache() / 1e6)
+    trial_store = TrialStore(TOTAL_TRIALS * NUM_BLOCKS)
+    timestamp = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+    wait_log = []  # (block, trial, event kind, deadline overshoot in ns)
+    save_plan(plan, f"oddball_plan_{user_name}_{timestamp}.json")
+    settings = session_settings + [('plan_source', plan_source), ('plan_seed', plan['seed']), ('isi_distribution', ISI_DISTRIBUTION),
+                                   ('cohort_settings', cohort_settings_path(COHORT_SETTINGS_DIR, user_name) if cohort else 'none'),
+                                   ('cohort_cell', cohort['cell'] if cohort else '')]
+    key_log = KeyEventLog(user_name, timestamp)
+    session_db = None
+    if SESSION_DB:
+        variant = '/'.join(dict.fromkeys(condition['stim_type'] for condition in block_conditions))
+        session_db = SessionDatabase(SESSION_DB, user_name, variant, dict(zip(AUTORUN_PARAMS, param_values), isi_distribution=ISI_DISTRIBUTION, fixation_cross=FIXATION_CROSS),
+                                     settings, trial_store, wait_log, key_log)
+    session_log = SessionLog(user_name, timestamp, trial_store, session_db, key_log, wait_log)
+    session_log.add({'trial': 'setting', 'stim_type': name, 'value': value} for name, value in settings)
+    timebase = SessionTimebase()
+    session_log.add(timebase.anchors)
+    session_log.flush()
     experiment_running = True
 
     for block_num in range(1, NUM_BLOCKS + 1):
         if not experiment_running:
             break
 
-        num_standards = int(TOTAL_TRIALS * (1 - TARGET_PROB))
-        num_targets = int(TOTAL_TRIALS * TARGET_PROB)
-        trials = ['standard'] * (num_standards - 1) + ['target'] * num_targets
-        random.shuffle(trials)
-        trials.insert(0, 'standard')  # Force first trial to be standard
-        
-        trial_idx = 0
-        while trial_idx < TOTAL_TRIALS and experiment_running:
-            # Display fixation cross if enabled
-            if FIXATION_CROSS:
-                screen.fill(BLACK)
-                pygame.draw.line(screen, WHITE, (WIDTH // 2 - 20, HEIGHT // 2), (WIDTH // 2 + 20, HEIGHT // 2), 4)  # Horizontal
-                pygame.draw.line(screen, WHITE, (WIDTH // 2, HEIGHT // 2 - 20), (WIDTH // 2, HEIGHT // 2 + 20), 4)  # Vertical
-                pygame.display.flip()
-                fixation_start_time = time.time()
-                while time.time() < fixation_start_time + FIXATION_DURATION / 1000:  # Convert ms to seconds
-                    for event in pygame.event.get():
-                        if event.type == pygame.QUIT:
-                            pygame.quit()
-                            exit()
-                        if event.type == pygame.VIDEORESIZE:
-                            WIDTH, HEIGHT = event.w, event.h
-                            screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
-
-            # Now present the stimulus
-            screen.fill(BLACK)  # Changed to BLACK background
-            stim_type = trials[trial_idx]
-            
-            # Set pulse duration based on stimulus type
-            pulse_duration = STANDARD_PULSE if stim_type == 'standard' else TARGET_PULSE
-            
-            # Draw main stimulus
-            if stim_type == 'standard':
-                if STIM_TYPE in ["both", "visual"]:
-                    pygame.draw.circle(screen, RED, (WIDTH // 2, HEIGHT // 2), 100)
-                if STIM_TYPE in ["both", "audio"]:
-                    standard_sound.play()
-            else:  # target
-                if STIM_TYPE in ["both", "visual"]:
-                    pygame.draw.polygon(screen, GREEN, 
-                                       [(WIDTH // 2, HEIGHT // 2 - 100), 
-                                        (WIDTH // 2 - 100, HEIGHT // 2 + 100), 
-                                        (WIDTH // 2 + 100, HEIGHT // 2 + 100)])
-                if STIM_TYPE in ["both", "audio"]:
-                    target_sound.play()
-            
-            # Draw initial white square for both trial types
-            pygame.draw.rect(screen, WHITE, (WIDTH - SQUARE_SIZE - 10, HEIGHT - SQUARE_SIZE - 10, SQUARE_SIZE, SQUARE_SIZE))
-            
-            pygame.display.flip()
-            stim_start_time = time.time()
-            response_made = False
-            square_active = True
-            
-            pulse_end_time = stim_start_time + pulse_duration / 1000
-            stim_end_time = stim_start_time + STIM_DURATION / 1000
-            
-            # Run loop until the longer of STIM_DURATION and pulse_duration
-            end_time = max(stim_end_time, pulse_end_time)
-            while time.time() < end_time:
-                current_time = time.time()
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        pygame.quit()
-                        exit()
-                    if event.type == pygame.VIDEORESIZE:
-                        WIDTH, HEIGHT = event.w, event.h
-                        screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
-                    if event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_ESCAPE:
-                            # Pause and show quit prompt
-                            screen.fill(BLACK)
-                            quit_text = prompt_font.render("Quit? (Y/N)", True, WHITE)
-                            screen.blit(quit_text, (WIDTH // 2 - quit_text.get_width() // 2, HEIGHT // 2 - quit_text.get_height() // 2))
-                            pygame.display.flip()
-                            
-                            waiting_for_quit_response = True
-                            while waiting_for_quit_response:
-                                for quit_event in pygame.event.get():
-                                    if quit_event.type == pygame.QUIT:
-                                        pygame.quit()
-                                        exit()
-                                    if quit_event.type == pygame.KEYDOWN:
-                                        if quit_event.key == pygame.K_y:
-                                            experiment_running = False  # Break out of experiment loop
-                                            waiting_for_quit_response = False
-                                            break  # Return to main menu
-                                        elif quit_event.key == pygame.K_n:
-                                            waiting_for_quit_response = False
-                                            # Redraw the current stimulus
-                                            screen.fill(BLACK)
-                                            if current_time < stim_end_time and STIM_TYPE in ["both", "visual"]:
-                                                if stim_type == 'standard':
-                                                    pygame.draw.circle(screen, RED, (WIDTH // 2, HEIGHT // 2), 100)
-                                                elif stim_type == 'target':
-                                                    pygame.draw.polygon(screen, GREEN, 
-                                                                       [(WIDTH // 2, HEIGHT // 2 - 100), 
-                                                                        (WIDTH // 2 - 100, HEIGHT // 2 + 100), 
-                                                                        (WIDTH // 2 + 100, HEIGHT // 2 + 100)])
-                                            pygame.draw.rect(screen, WHITE if square_active else BLACK, 
-                                                            (WIDTH - SQUARE_SIZE - 10, HEIGHT - SQUARE_SIZE - 10, SQUARE_SIZE, SQUARE_SIZE))
-                                            pygame.display.flip()
-                                            # Adjust timing to account for pause
-                                            pause_duration = time.time() - current_time
-                                            stim_end_time += pause_duration
-                                            pulse_end_time += pause_duration
-                                            end_time = max(stim_end_time, pulse_end_time)
-                                            break
+        # Deadlines are absolute from block start; a pause moves block_start_time,
+        # so later trials shift by exactly the pause and overshoot never accumulates
+        apply_condition(block_conditions[block_num - 1])
+        if frame_cache_size != (WIDTH, HEIGHT):  # Resized on the target count or break screen
+            telemetry.log(TELEMETRY_DEBUG, "Frame cache rebuilt for {}x{} in {:.1f} ms", WIDTH, HEIGHT, build_frame_cache() / 1e6)
+        sounds = (None, standard_sound, target_sound)
+        session_log.add([{'block': block_num, 'trial': 'condition', 'stim_type': STIM_TYPE,
+                          'value': json.dumps(block_conditions[block_num - 1])}])
+        frame_clock.resync()
+        block_start_anchor = timebase.anchor('block_start', block_num)
+        session_log.add([block_start_anchor])
+        if key_reader is not None:
+            key_reader.queue.clear()  # Drop presses made between blocks
+        # A sound led by the A/V offset can be due before the first onset, so start
+        # the block late enough (in whole refreshes) for it to still be ahead of us
+        lead_ns = max(0, -int(timelines[block_num - 1]['at_ns'].min()))
+        block_start_time = frame_clock.now_ns() + frame_clock.period_ns * (1 + -(-lead_ns // frame_clock.period_ns))
+        state = BLANK
+        full_redraw = True  # Next transition repaints the whole window, which still shows the countdown or break screen
+        pending_resize = None
+        deferred_resizes = 0
+        responses_open = False  # From stimulus onset until the end of the trial's ISI
+        # Trial whose stimulus was shown last. Presses belong to it, not to the loop's
+        # trial_idx: the next trial's sound can be due before this one's ISI ends
+        response_trial, response_target = 0, False
+        # The rest of the trial's state is set as its events are presented; the
+        # timeline always puts the onset first, but start every block from a known state
+        response_made = False
+        stim_type = None
+        stim_onset_ns = scheduled_onset_ns = pulse_off_ns = stim_off_ns = isi_blank_ns = None
+        trial_log_start = len(trial_store)
+        trial_dropped_start = frame_clock.dropped
+        sound_onsets = {}  # Trial -> real time its sound was started, kept apart from the trial state since it can lead the onset
+        for trial_idx, kind, at_ns, next_state, is_target, sound in timelines[block_num - 1].tolist():
+            waiter = TrialWait(block_start_time + at_ns, responses_open)
+            for event in waiter:
+                current_time = waiter.now_ns  # Capture time before potential pause
+                if event.type == pygame.QUIT:
+                    session_log.close('aborted')
+                    pygame.quit()
+                    exit()
+                if event.type == pygame.VIDEORESIZE:
+                    # Reallocating the display mid-trial stalls the flip, so keep the
+                    # latest size and apply it once the block is over
+                    pending_resize = (event.w, event.h)
+                    deferred_resizes += 1
+                if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+                    key_log.record(block_num, response_trial + 1, event.type == pygame.KEYDOWN, event.key,
+                                   timebase.since_start(getattr(event, 'clock_ns', waiter.event_ns)))
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        # Pause and show quit prompt
+                        screen.fill(BLACK)
+                        quit_text = render_text(prompt_font, "Quit? (Y/N)", WHITE)
+                        screen.blit(quit_text, (WIDTH // 2 - quit_text.get_width() // 2, HEIGHT // 2 - quit_text.get_height() // 2))
+                        frame_clock.flip()
                         
-                        elif event.key == pygame.K_SPACE:
-                            rt = round((current_time - stim_start_time) * 1000, 2)
-                            if stim_type == 'target' and not response_made:
-                                all_logs.append({'block': block_num, 'trial': trial_idx + 1, 'stim_type': stim_type, 'reaction_time': rt, 'correct': 1, 'target': 1, 'reported_targets': None})
-                                print(f"Block {block_num}, Trial {trial_idx + 1}, Stim: {stim_type}, RT: {rt} ms, Correct")
-                                correct_chime.play()
-                                response_made = True
-                            else:
-                                all_logs.append({'block': block_num, 'trial': trial_idx + 1, 'stim_type': stim_type, 'reaction_time': rt, 'correct': 0, 'target': 0 if stim_type == 'standard' else 1, 'reported_targets': None})
-                                print(f"Block {block_num}, Trial {trial_idx + 1}, Stim: {stim_type}, RT: {rt} ms, Incorrect")
-                                incorrect_chime.play()
-                
-                # Update square to black after pulse duration
-                if current_time >= pulse_end_time and square_active:
-                    screen.fill(BLACK)  # Changed to BLACK background
-                    if current_time < stim_end_time and STIM_TYPE in ["both", "visual"]:
-                        if stim_type == 'standard':
-                            pygame.draw.circle(screen, RED, (WIDTH // 2, HEIGHT // 2), 100)
-                        elif stim_type == 'target':
-                            pygame.draw.polygon(screen, GREEN, 
-                                              [(WIDTH // 2, HEIGHT // 2 - 100), 
-                                               (WIDTH // 2 - 100, HEIGHT // 2 + 100), 
-                                               (WIDTH // 2 + 100, HEIGHT // 2 + 100)])
-                    pygame.draw.rect(screen, BLACK, (WIDTH - SQUARE_SIZE - 10, HEIGHT - SQUARE_SIZE - 10, SQUARE_SIZE, SQUARE_SIZE))
-                    pygame.display.flip()
-                    square_active = False
-                
-                # Clear stimulus if STIM_DURATION ends but pulse_duration continues
-                if current_time >= stim_end_time and current_time < pulse_end_time and STIM_TYPE in ["both", "visual"]:
-                    screen.fill(BLACK)
-                    pygame.draw.rect(screen, WHITE, (WIDTH - SQUARE_SIZE - 10, HEIGHT - SQUARE_SIZE - 10, SQUARE_SIZE, SQUARE_SIZE))
-                    pygame.display.flip()
-            
-            screen.fill(BLACK)  # Changed to BLACK background
-            pygame.display.flip()
-            
-            isi = BASE_ISI if not ISI_VARIES else random.uniform(BASE_ISI - 500, BASE_ISI + 500)
-            isi = max(50, isi)  # Minimum 50 ms
-            end_isi_time = stim_start_time + (max(STIM_DURATION, pulse_duration) + isi) / 1000  # Start ISI after the longer duration
-            while time.time() < end_isi_time and experiment_running:
-                current_time = time.time()  # Capture time before potential pause
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        pygame.quit()
-                        exit()
-                    if event.type == pygame.VIDEORESIZE:
-                        WIDTH, HEIGHT = event.w, event.h
-                        screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
-                    if event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_ESCAPE:
-                            # Pause and show quit prompt during ISI
-                            screen.fill(BLACK)
-                            quit_text = prompt_font.render("Quit? (Y/N)", True, WHITE)
-                            screen.blit(quit_text, (WIDTH // 2 - quit_text.get_width() // 2, HEIGHT // 2 - quit_text.get_height() // 2))
-                            pygame.display.flip()
-                            
-                            waiting_for_quit_response = True
-                            while waiting_for_quit_response:
-                                for quit_event in pygame.event.get():
-                                    if quit_event.type == pygame.QUIT:
-                                        pygame.quit()
-                                        exit()
-                                    if quit_event.type == pygame.KEYDOWN:
-                                        if quit_event.key == pygame.K_y:
-                                            experiment_running = False  # Break out of experiment loop
-                                            waiting_for_quit_response = False
-                                            break  # Return to main menu
-                                        elif quit_event.key == pygame.K_n:
-                                            waiting_for_quit_response = False
-                                            screen.fill(BLACK)
-                                            pygame.display.flip()
-                                            # Adjust ISI timing
-                                            pause_duration = time.time() - current_time
-                                            end_isi_time += pause_duration
-                                            break
-                        elif event.key == pygame.K_SPACE and not response_made:
-                            rt = round((time.time() - stim_start_time) * 1000, 2)
-                            if stim_type == 'target':
-                                all_logs.append({'block': block_num, 'trial': trial_idx + 1, 'stim_type': stim_type, 'reaction_time': rt, 'correct': 1, 'target': 1, 'reported_targets': None})
-                                print(f"Block {block_num}, Trial {trial_idx + 1}, Stim: {stim_type}, RT: {rt} ms, Correct")
-                                correct_chime.play()
-                                response_made = True
-                            else:
-                                all_logs.append({'block': block_num, 'trial': trial_idx + 1, 'stim_type': stim_type, 'reaction_time': rt, 'correct': 0, 'target': 0, 'reported_targets': None})
-                                print(f"Block {block_num}, Trial {trial_idx + 1}, Stim: {stim_type}, RT: {rt} ms, Incorrect")
-                                incorrect_chime.play()
-            
-            # Log the trial even if no response was made
-            if not response_made and experiment_running:
-                all_logs.append({
-                    'block': block_num,
-                    'trial': trial_idx + 1,
-                    'stim_type': stim_type,
-                    'reaction_time': None,
-                    'correct': 0 if stim_type == 'target' else 1,
-                    'target': 1 if stim_type == 'target' else 0,
-                    'reported_targets': None
+                        waiting_for_quit_response = True
+                        while waiting_for_quit_response:
+                            # Block on the event queue like the menu screens; the paused block doesn't need the CPU
+                            for quit_event in [pygame.event.wait(MENU_WAIT_MS)] + pygame.event.get():
+                                if quit_event.type == pygame.QUIT:
+                                    session_log.close('aborted')
+                                    pygame.quit()
+                                    exit()
+                                if quit_event.type == pygame.KEYDOWN:
+                                    if quit_event.key == pygame.K_y:
+                                        experiment_running = False  # Break out of experiment loop
+                                        waiting_for_quit_response = False
+                                        break  # Return to main menu
+                                    elif quit_event.key == pygame.K_n:
+                                        waiting_for_quit_response = False
+                                        if key_reader is not None:
+                                            key_reader.queue.clear()  # Presses made during the pause, as the pygame backend drops them here too
+                                        # Redraw the current display state
+                                        draw_state(state)
+                                        frame_clock.resync()
+                                        frame_clock.flip()
+                                        # Shift the rest of the block by the pause
+                                        pause_duration = frame_clock.now_ns() - current_time
+                                        block_start_time += pause_duration
+                                        waiter.deadline_ns += pause_duration
+                                        break
+                    
+                    # Presses count from onset; in the ISI only until the first correct one
+                    elif event.key == pygame.K_SPACE and responses_open and not (state == BLANK and response_made):
+                        press_ns = getattr(event, 'clock_ns', waiter.event_ns)  # Kernel timestamp from the evdev reader
+                        rt = (press_ns - stim_onset_ns) / 1e6
+                        response_ns = timebase.since_start(press_ns)
+                        if response_target and not response_made:
+                            trial_store.append(block=block_num, trial=response_trial + 1, target=1, reaction_time=rt, correct=1, response_ns=response_ns)
+                            telemetry.log(TELEMETRY_TRIAL, "Block {}, Trial {}, Stim: {}, RT: {:.2f} ms, Correct", block_num, response_trial + 1, stim_type, rt)
+                            correct_chime.play()
+                            response_made = True
+                        else:
+                            trial_store.append(block=block_num, trial=response_trial + 1, target=response_target, reaction_time=rt, correct=0, response_ns=response_ns)
+                            telemetry.log(TELEMETRY_TRIAL, "Block {}, Trial {}, Stim: {}, RT: {:.2f} ms, Incorrect", block_num, response_trial + 1, stim_type, rt)
+                            incorrect_chime.play()
+                if not experiment_running:
+                    break
+            if not experiment_running:
+                break
+            if kind & SOUND_ON and next_state == NO_CHANGE:
+                # FrameWait returns a refresh early for the flip; a lone sound waits out the rest
+                sound_due_ns = frame_clock.real_ns(waiter.deadline_ns)
+                sleep_until(sound_due_ns)
+                waiter.overshoot_ns = clock_ns() - sound_due_ns
+            wait_log.append((block_num, trial_idx + 1, kind, waiter.overshoot_ns))
+
+            if kind == ISI_END:
+                # Log the trial even if no response was made
+                if not response_made:
+                    trial_store.append(block=block_num, trial=trial_idx + 1, target=is_target, correct=0 if is_target else 1)
+                    telemetry.log(TELEMETRY_TRIAL, "Block {}, Trial {}, Stim: {}, No response", block_num, trial_idx + 1, stim_type)
+                pulse_duration = plan['blocks'][block_num - 1]['pulse_ms'][trial_idx]
+                if FRAME_LOCKED:
+                    # Requested vs delivered refreshes, delivered measured from real flip times
+                    trial_timing = {
+                        'pulse_frames_requested': frame_clock.frames(pulse_duration),
+                        'pulse_frames_delivered': round((pulse_off_ns - stim_onset_ns) / frame_clock.period_ns),
+                        'stim_frames_requested': frame_clock.frames(STIM_DURATION) if stim_off_ns is not None else None,
+                        'stim_frames_delivered': round((stim_off_ns - stim_onset_ns) / frame_clock.period_ns) if stim_off_ns is not None else None
+                    }
+                else:
+                    trial_timing = {}
+                # Flip timestamps in ns since session start, taken right after each flip returns
+                trial_timing.update({
+                    'stim_onset_ns': timebase.since_start(stim_onset_ns),
+                    'onset_error_ns': stim_onset_ns - scheduled_onset_ns,
+                    'diode_off_ns': timebase.since_start(pulse_off_ns),
+                    'stim_clear_ns': timebase.since_start(stim_off_ns) if stim_off_ns is not None else None,
+                    'isi_blank_ns': timebase.since_start(isi_blank_ns),
+                    'dropped_frames': frame_clock.dropped - trial_dropped_start
                 })
-                print(f"Block {block_num}, Trial {trial_idx + 1}, Stim: {stim_type}, No response")
-            
-            trial_idx += 1
-
-        if experiment_running:
-            # Ask participant how many targets they saw at the end of each block
-            target_count = ""
-            getting_target_count = True
-            while getting_target_count:
-                screen.fill(DARK_GRAY)
-                pygame.draw.rect(screen, BLACK, (WIDTH // 4, HEIGHT // 4, WIDTH // 2, HEIGHT // 2), 5)
-                prompt_text1 = prompt_font.render(f"Block {block_num} finished", True, WHITE)
-                prompt_text2 = prompt_font.render("How many targets did you see?", True, WHITE)
-                prompt_text3 = info_font.render(target_count + "|", True, WHITE)
-                prompt_text4 = info_font.render("Press Enter to continue", True, CYAN)
-                screen.blit(prompt_text1, (WIDTH // 2 - prompt_text1.get_width() // 2, HEIGHT // 2 - 80))
-                screen.blit(prompt_text2, (WIDTH // 2 - prompt_text2.get_width() // 2, HEIGHT // 2 - 30))
-                screen.blit(prompt_text3, (WIDTH // 2 - prompt_text3.get_width() // 2, HEIGHT // 2 + 20))
-                screen.blit(prompt_text4, (WIDTH // 2 - prompt_text4.get_width() // 2, HEIGHT // 2 + 70))
-                pygame.display.flip()
+                if trial_idx in sound_onsets:
+                    # Residual asynchrony at the participant: play/flip gap plus the station's path difference
+                    trial_timing['sound_onset_ns'] = timebase.since_start(sound_onsets[trial_idx])
+                    trial_timing['av_asynchrony_ns'] = sound_onsets.pop(trial_idx) - stim_onset_ns + av_offset_ns
+                trial_store.update(trial_log_start, trial_timing)
+                session_log.add_trials(trial_log_start, len(trial_store))  # Written at the next safe point
+                responses_open = False
+                trial_dropped_start = frame_clock.dropped
+                continue
 
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        pygame.quit()
-                        exit()
-                    if event.type == pygame.VIDEORESIZE:
-                        WIDTH, HEIGHT = event.w, event.h
-                        screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
-                    if event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_RETURN and target_count:
-                            getting_target_count = False
-                            # Store the participant's count in the logs
-                            all_logs.append({
-                                'block': block_num,
-                                'trial': 'summary',
-                                'stim_type': 'target_count',
-                                'reaction_time': None,
-                                'correct': None,
-                                'target': None,
-                                'reported_targets': int(target_count)
-                            })
-                        elif event.key == pygame.K_BACKSPACE:
-                            target_count = target_count[:-1]
-                        elif event.unicode.isdigit():
-                            target_count += event.unicode
-
-        if block_num < NUM_BLOCKS and experiment_running:
-            screen.fill(DARK_GRAY)
-            pygame.draw.rect(screen, BLACK, (WIDTH // 4, HEIGHT // 4, WIDTH // 2, HEIGHT // 2), 5)
-            break_text1 = prompt_font.render(f"Block {block_num} finished", True, WHITE)
-            break_text2 = prompt_font.render(f"Ready for block {block_num + 1}?", True, WHITE)
-            break_text3 = info_font.render("Press any key when ready", True, CYAN)
-            screen.blit(break_text1, (WIDTH // 2 - break_text1.get_width() // 2, HEIGHT // 2 - 70))
-            screen.blit(break_text2, (WIDTH // 2 - break_text2.get_width() // 2, HEIGHT // 2 - 20))
-            screen.blit(break_text3, (WIDTH // 2 - break_text3.get_width() // 2, HEIGHT // 2 + 40))
-            pygame.display.flip()
+            scheduled_ns = frame_clock.real_ns(waiter.deadline_ns)
+            if sound:
+                sounds[sound].play()
+                sound_onsets[trial_idx] = clock_ns()
+            if next_state == NO_CHANGE:
+                continue
+            if full_redraw:
+                draw_state(next_state)
+                frame_clock.flip(waiter.deadline_ns)
+                full_redraw = False
+            else:
+                frame_clock.flip(waiter.deadline_ns, draw_transition(state, next_state))
+            state = next_state
+            if kind & STIM_ON:
+                stim_onset_ns = frame_clock.last_flip_ns  # Real flip time, used for RTs in both modes
+                scheduled_onset_ns = scheduled_ns
+                response_trial, response_target = trial_idx, is_target
+                stim_type = 'target' if is_target else 'standard'
+                pulse_off_ns = stim_off_ns = None
+                response_made = False
+                responses_open = True
+                trial_log_start = len(trial_store)
+            if kind & DIODE_OFF:
+                pulse_off_ns = frame_clock.last_flip_ns
+            if kind & STIM_OFF:
+                stim_off_ns = frame_clock.last_flip_ns
+            if state == BLANK:
+                isi_blank_ns = frame_clock.last_flip_ns
+                session_log.flush()  # The ISI blank is the quietest stretch of a trial
+
+        block_end_anchor = timebase.anchor('block_end', block_num)
+        session_log.add([block_end_anchor])
+        if pending_resize is not None:
+            WIDTH, HEIGHT = pending_resize
+            screen = pygame.display.set_mode((WIDTH, HEIGHT), DISPLAY_FLAGS, vsync=DISPLAY_VSYNC)
+            session_log.add([{'block': block_num, 'trial': 'resize', 'stim_type': f"{WIDTH}x{HEIGHT}", 'value': deferred_resizes,
+                              'session_ns': timebase.since_start(clock_ns())}])
+            telemetry.log(TELEMETRY_INFO, "Block {}: applied {} deferred resize event(s), window now {}x{}", block_num, deferred_resizes, WIDTH, HEIGHT)
+        block_overshoots = [w[3] for w in wait_log if w[0] == block_num]
+        if block_overshoots:
+            telemetry.log(TELEMETRY_INFO, "Block {} deadline overshoot: mean {:.3f} ms, max {:.3f} ms", block_num,
+                          np.mean(block_overshoots) / 1e6, max(block_overshoots) / 1e6)
+
+        reported_targets = None
+        if experiment_running and autorun is None:
+            reported_targets = int(TargetCountScreen(block_num).run().target_count)
+            # Store the participant's count in the logs
+            session_log.add([{
+                'block': block_num,
+                'trial': 'summary',
+                'stim_type': 'target_count',
+                'reported_targets': reported_targets
+            }])
+        session_log.flush()
+        key_log.flush()
+        if session_db is not None and experiment_running:
+            session_db.write_block(block_num, block_start_anchor, block_end_anchor, reported_targets)
 
-            waiting = True
-            while waiting:
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        pygame.quit()
-                        exit()
-                    if event.type == pygame.VIDEORESIZE:
-                        WIDTH, HEIGHT = event.w, event.h
-                        screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
-                    if event.type == pygame.KEYDOWN:
-                        waiting = False
+        if block_num < NUM_BLOCKS and experiment_running and autorun is None:
+            lines = [(prompt_font, f"Block {block_num} finished", WHITE, -70),
+                     (prompt_font, f"Ready for block {block_num + 1}?", WHITE, -20),
+                     (info_font, "Press any key when ready", CYAN, 40)]
+            if block_conditions[block_num] != block_conditions[block_num - 1]:
+                lines[2:] = [(info_font, "Press the spacebar " + instruction_text(block_conditions[block_num]), WHITE, 20),
+                             (info_font, "Press any key when ready", CYAN, 60)]
+            MessageScreen(lines).run()
+
+    # Save logs; a session quit from the ESC prompt keeps what was collected, marked as aborted
+    session_log.close('complete' if experiment_running else 'aborted')
 
     if experiment_running:
-        # Save logs
-        timestamp = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-        filename = f"oddball_log_{user_name}_{timestamp}.csv"
-        print(f"Final log before saving: {all_logs}")
-        with open(filename, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=['block', 'trial', 'stim_type', 'reaction_time', 'correct', 'target', 'reported_targets'])
-            writer.writeheader()
-            writer.writerows(all_logs)
+        telemetry.log(TELEMETRY_INFO, "Saved {} trial records to {}", len(trial_store), session_log.path)
+        if autorun:
+            break
 
         # End screen
-        screen.fill(DARK_GRAY)
-        pygame.draw.rect(screen, BLACK, (WIDTH // 4, HEIGHT // 4, WIDTH // 2, HEIGHT // 2), 5)
-        end_text = prompt_font.render("Thank you for participating!", True, WHITE)
-        restart_text = info_font.render("Press X to go to the main menu", True, CYAN)
-        screen.blit(end_text, (WIDTH // 2 - end_text.get_width() // 2, HEIGHT // 2 - 50))
-        screen.blit(restart_text, (WIDTH // 2 - restart_text.get_width() // 2, HEIGHT // 2 + 20))
-        pygame.display.flip()
-
-        waiting = True
-        while waiting:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    exit()
-                if event.type == pygame.VIDEORESIZE:
-                    WIDTH, HEIGHT = event.w, event.h
-                    screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
-                if event.type == pygame.KEYDOWN and event.key == pygame.K_x:
-                    waiting = False
+        MessageScreen([(prompt_font, "Thank you for participating!", WHITE, -50),
+                       (info_font, "Press X to go to the main menu", CYAN, 20)], keys={pygame.K_x}).run()
 
 # Cleanup
 pygame.quit()
\ No newline at end of file
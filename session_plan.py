@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Session plans for oddball10.py.
+
+A plan holds everything oddball10.py would otherwise draw at runtime: each
+block's trial types, per-trial ISIs and diode pulse lengths, plus the seed they
+were drawn from, so a session can be audited and replayed exactly. Each block
+also records the exact mean and SD of its ISI distribution next to the drawn
+values' statistics. Plans are
+JSON files named <participant>.json in a plan directory; oddball10.py loads the
+one matching the participant name and otherwise draws a plan from a fresh seed
+and saves it next to the session log.
+
+Run as a script to pre-generate plans for a whole cohort in parallel:
+
+    python session_plan.py session_plans P001 P002 P003 --trials 100 --blocks 4
+"""
+
+import argparse
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Defaults match oddball10.py's parameter menu
+DEFAULT_PARAMETERS = {
+    "trials": 25, "blocks": 1, "target_prob": 0.2, "stim_duration": 500, "fixation_duration": 750,
+    "isi": 1000, "isi_distribution": "fixed", "isi_spread": 500, "isi_scale": 500, "isi_values": None,
+    "target_pulse": 512, "standard_pulse": 128,
+    "leading_standards": 1, "min_standards_between_targets": 1, "max_run_length": None
+}
+
+# Trial sequences are built from run lengths: gaps of standards alternating with
+# runs of targets, which are single targets unless min_gap is 0. Each block has
+# exactly n trials and round(n * target_prob) targets. Every length is drawn
+# within its bounds (min_gap and max_run, which doesn't count the leading
+# standards), so nothing is rejected and impossible settings fail up front.
+
+def bounded_composition(rng, total, low, high):
+    # Splits total into parts with low <= part <= high: the slack over low is split
+    # uniformly (stars and bars), parts over their cap are clipped and the excess is
+    # split again among the parts with room. Each round fills at least one part.
+    parts = low.copy()
+    excess = total - low.sum()
+    while excess:
+        room = np.flatnonzero(parts < high)
+        bars = np.sort(rng.choice(excess + len(room) - 1, len(room) - 1, replace=False))
+        parts[room] += np.diff(bars, prepend=-1, append=excess + len(room) - 1) - 1
+        excess = np.maximum(parts - high, 0).sum()
+        np.minimum(parts, high, out=parts)
+    return parts
+
+def generate_sequence(rng, n, target_prob, leading=1, min_gap=1, max_run=None):
+    # Boolean is-target array for one block
+    lead = min(leading, n)
+    m = n - lead
+    k = round(n * target_prob)
+    standards = m - k
+    if k > m - min_gap * max(k - 1, 0):
+        raise ValueError(f"{k} targets {min_gap} standard(s) apart don't fit in {m} trials after {lead} leading standard(s)")
+    run = n if max_run is None else max_run
+    gap = max(min_gap, 1)  # Least standards between two target runs
+    target_run = 1 if min_gap else run
+    # r target runs hold the k targets and the r + 1 gaps around them, at most run
+    # each, the standards. The r - 1 gaps between runs need gap to run standards,
+    # so with gap > run there's room for one run at most
+    fewest = max(-(-k // target_run), -(-(standards - run) // run))
+    most = min(k, standards // gap + 1 if gap <= run else 1)
+    if fewest > most:
+        raise ValueError(f"{k} targets and {standards} standards don't fit in runs of at most {max_run} after {lead} leading standard(s)")
+    r = k
+    if min_gap == 0 and k:
+        # As many target runs as the targets would form scattered at random, within bounds
+        positions = np.sort(rng.choice(m, k, replace=False))
+        r = int(np.clip(1 + np.count_nonzero(np.diff(positions) > 1), fewest, most))
+    low = np.full(r + 1, gap)
+    low[[0, -1]] = 0
+    high = np.full(r + 1, run)
+    lengths = np.empty(2 * r + 1, dtype=int)
+    lengths[0::2] = bounded_composition(rng, standards, low, high)
+    lengths[1::2] = bounded_composition(rng, k, np.ones(r, dtype=int), np.full(r, target_run))
+    lengths[0] += lead
+    return np.repeat(np.arange(2 * r + 1) % 2 == 1, lengths)
+
+# ISI distributions, by the name stored in a plan's isi_distribution. Each takes
+# the generator, the plan parameters and every trial's fixation + stimulus time
+# in ms, draws the whole block's ISIs in one go and returns them with the
+# distribution's exact mean and SD. "isi" is the centre of the range (the SOA
+# for fixed_soa); ranges are isi +- isi_spread, starting no lower than ISI_MIN_MS
+# so nothing has to be clamped after drawing.
+ISI_MIN_MS = 50
+
+def isi_range(p):
+    return max(ISI_MIN_MS, p["isi"] - p["isi_spread"]), p["isi"] + p["isi_spread"]
+
+def fixed_isis(rng, p, on_ms):
+    isi = max(ISI_MIN_MS, p["isi"])
+    return np.full(len(on_ms), float(isi)), isi, 0.0
+
+def uniform_isis(rng, p, on_ms):
+    low, high = isi_range(p)
+    return rng.uniform(low, high, len(on_ms)), (low + high) / 2, (high - low) / math.sqrt(12)
+
+def exponential_isis(rng, p, on_ms):
+    # Truncated exponential: constant hazard over the range, so the time already
+    # waited says nothing about when the next stimulus comes
+    low, high = isi_range(p)
+    scale, width = p["isi_scale"], high - low
+    if width == 0:
+        return np.full(len(on_ms), float(low)), low, 0.0
+    isis = low - scale * np.log1p(-rng.random(len(on_ms)) * -math.expm1(-width / scale))
+    tail = width / math.expm1(width / scale)
+    return isis, low + scale - tail, math.sqrt(scale ** 2 - tail ** 2 * math.exp(width / scale))
+
+def discrete_isis(rng, p, on_ms):
+    # Equally likely values from isi_values, by default the range's ends and centre
+    values = np.array(p["isi_values"] or sorted({*isi_range(p), p["isi"]}), dtype=float)
+    if values.min() < ISI_MIN_MS:
+        raise ValueError(f"ISI values must be at least {ISI_MIN_MS} ms")
+    return rng.choice(values, len(on_ms)), values.mean(), values.std()
+
+def fixed_soa_isis(rng, p, on_ms):
+    # Constant onset-to-onset time: each ISI takes up what the trial's fixation and stimulus leave
+    isis = p["isi"] - on_ms
+    if isis.min() < ISI_MIN_MS:
+        raise ValueError(f"SOA {p['isi']} ms leaves under {ISI_MIN_MS} ms of ISI after {on_ms.max()} ms of fixation and stimulus")
+    return isis, isis.mean(), isis.std()
+
+ISI_DISTRIBUTIONS = {"fixed": fixed_isis, "uniform": uniform_isis, "exponential": exponential_isis,
+                     "discrete": discrete_isis, "fixed_soa": fixed_soa_isis}
+
+def derive_seed(entropy=None):
+    # A seed from fresh entropy, or derived from the given entropy. Kept to 63 bits
+    # so it fits the signed 64-bit integers of the session database
+    return int(np.random.SeedSequence(entropy).generate_state(1, np.uint64)[0]) & ((1 << 63) - 1)
+
+def make_plan(participant, seed=None, **parameters):
+    # Draw a plan; seed=None draws a fresh seed, which is recorded in the plan
+    parameters = dict(DEFAULT_PARAMETERS, **parameters)
+    if seed is None:
+        seed = derive_seed()
+    rng = np.random.default_rng(seed)
+    blocks = []
+    for _ in range(parameters["blocks"]):
+        is_target = generate_sequence(rng, parameters["trials"], parameters["target_prob"], parameters["leading_standards"],
+                                      parameters["min_standards_between_targets"], parameters["max_run_length"])
+        pulse_ms = np.where(is_target, parameters["target_pulse"], parameters["standard_pulse"])
+        on_ms = parameters["fixation_duration"] + np.maximum(parameters["stim_duration"], pulse_ms)
+        isis, mean, sd = ISI_DISTRIBUTIONS[parameters["isi_distribution"]](rng, parameters, on_ms)
+        isis = isis.round(3)
+        blocks.append({
+            "target": is_target.astype(int).tolist(),
+            "isi_ms": isis.tolist(),
+            "pulse_ms": pulse_ms.tolist(),
+            "isi_stats": {"mean": mean, "sd": sd, "drawn_mean": isis.mean(), "drawn_sd": isis.std(),
+                          "drawn_min": isis.min(), "drawn_max": isis.max()}
+        })
+    return {"participant": participant, "seed": seed, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "parameters": parameters, "blocks": blocks}
+
+def plan_path(directory, participant):
+    return os.path.join(directory, f"{participant}.json")
+
+def save_plan(plan, path):
+    with open(path, 'w') as f:
+        json.dump(plan, f)
+
+def load_plan(directory, participant):
+    # The participant's plan, or None if none was generated
+    try:
+        with open(plan_path(directory, participant)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_plan(job):
+    directory, participant, seed, parameters = job
+    save_plan(make_plan(participant, seed, **parameters), plan_path(directory, participant))
+    return participant
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('directory', help="plan directory, created if missing")
+    parser.add_argument('participants', nargs='*', help="participant IDs")
+    parser.add_argument('--ids-file', help="file with one participant ID per line")
+    parser.add_argument('--seed', type=int, help="cohort seed; each participant's seed is derived from it (default: fresh entropy)")
+    parser.add_argument('--force', action='store_true', help="overwrite existing plans")
+    parser.add_argument('--jobs', type=int, help="worker processes (default: CPU count)")
+    for name, default in DEFAULT_PARAMETERS.items():
+        if name == "isi_distribution":
+            parser.add_argument('--isi-distribution', choices=list(ISI_DISTRIBUTIONS), default=default)
+        elif name == "isi_values":
+            parser.add_argument('--isi-values', type=float, nargs='+', help="ISIs in ms for the discrete distribution")
+        else:
+            parser.add_argument('--' + name.replace('_', '-'), type=float if isinstance(default, float) else int, default=default)
+    args = parser.parse_args()
+
+    participants = list(args.participants)
+    if args.ids_file:
+        with open(args.ids_file) as f:
+            participants += [line.strip() for line in f if line.strip()]
+    if not participants:
+        parser.error("no participant IDs given")
+    os.makedirs(args.directory, exist_ok=True)
+    existing = [p for p in participants if os.path.exists(plan_path(args.directory, p))]
+    if existing and not args.force:
+        parser.error(f"plans already exist for {', '.join(existing)} (use --force to overwrite)")
+
+    # With a cohort seed, each participant's seed depends only on it and their ID,
+    # so adding participants later doesn't change anyone's plan
+    parameters = {name: getattr(args, name) for name in DEFAULT_PARAMETERS}
+    jobs = [(args.directory, participant, None if args.seed is None else derive_seed([args.seed, *participant.encode()]), parameters)
+            for participant in participants]
+    with ProcessPoolExecutor(args.jobs) as pool:
+        for participant in pool.map(write_plan, jobs):
+            print(f"Wrote {plan_path(args.directory, participant)}")
+
+if __name__ == "__main__":
+    main()
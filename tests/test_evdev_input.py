@@ -0,0 +1,70 @@
+# Tests for evdev_input.EvdevKeyReader, with a FIFO standing in for the input device
+import os
+import struct
+import sys
+import time
+import pygame
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from evdev_input import EvdevKeyReader
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason="needs POSIX FIFOs")
+
+EV_SYN, EV_KEY = 0, 1
+KEY_A, KEY_SPACE = 30, 57
+
+def input_event(type_, code, value, at_ns=None):
+    at_ns = time.time_ns() if at_ns is None else at_ns  # A FIFO can't take EVIOCSCLOCKID, so stamps are CLOCK_REALTIME
+    return struct.pack(EvdevKeyReader.EVENT_FORMAT, at_ns // 1_000_000_000, at_ns // 1000 % 1_000_000, type_, code, value)
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+@pytest.fixture
+def device(tmp_path):
+    # Reader on a FIFO, started, and the FIFO's write end
+    path = str(tmp_path / "event0")
+    os.mkfifo(path)
+    reader = EvdevKeyReader([path])
+    writer = os.open(path, os.O_WRONLY)
+    reader.start()
+    yield reader, writer
+    try:
+        os.close(writer)
+    except OSError:
+        pass
+    reader.join(timeout=2.0)
+
+def test_presses_and_releases(device):
+    reader, writer = device
+    press_ns = time.time_ns()
+    os.write(writer, input_event(EV_KEY, KEY_SPACE, 1, press_ns) + input_event(EV_SYN, 0, 0) +
+             input_event(EV_KEY, KEY_SPACE, 2) + input_event(EV_KEY, KEY_A, 1) +
+             input_event(EV_KEY, KEY_SPACE, 0, press_ns + 80_000_000))
+    assert wait_for(lambda: len(reader.queue) == 2)
+    down, up = reader.queue
+    assert (down.type, down.key) == (pygame.KEYDOWN, pygame.K_SPACE)
+    assert (up.type, up.key) == (pygame.KEYUP, pygame.K_SPACE)
+    # Mapped onto the reader's clock, keeping the kernel's spacing to the microsecond
+    assert up.clock_ns - down.clock_ns == 80_000_000
+    assert abs(down.clock_ns - time.monotonic_ns()) < 1_000_000_000
+    assert reader.error is None
+
+def test_closed_device_stops_reader(device):
+    reader, writer = device
+    os.write(writer, input_event(EV_KEY, KEY_SPACE, 1))
+    os.close(writer)
+    reader.join(timeout=2.0)
+    assert not reader.is_alive()
+    assert isinstance(reader.error, OSError)
+    assert [e.type for e in reader.queue] == [pygame.KEYDOWN]  # Read before the error, still there to drain
+
+def test_no_devices():
+    with pytest.raises(OSError):
+        EvdevKeyReader([])
@@ -0,0 +1,63 @@
+# Tests for session_plan.generate_sequence against every constraint it takes
+import itertools
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from session_plan import generate_sequence
+
+def longest_run(a):
+    return max((len(list(group)) for _, group in itertools.groupby(a)), default=0)
+
+def violations(is_target, n, k, lead, min_gap, max_run):
+    # The constraints a sequence breaks, empty if it's valid
+    broken = []
+    if len(is_target) != n:
+        broken.append("length")
+    if is_target.sum() != k:
+        broken.append("target count")
+    if is_target[:lead].any():
+        broken.append("leading standards")
+    if (np.diff(np.flatnonzero(is_target)) <= min_gap).any():
+        broken.append("min gap")
+    if max_run is not None and longest_run(is_target[lead:]) > max_run:
+        broken.append("max run")
+    return broken
+
+def feasible(n, k, lead, min_gap, max_run):
+    # Brute force: does any placement of k targets meet every constraint
+    for positions in itertools.combinations(range(n), k):
+        is_target = np.zeros(n, dtype=bool)
+        is_target[list(positions)] = True
+        if not violations(is_target, n, k, lead, min_gap, max_run):
+            return True
+    return False
+
+@pytest.mark.parametrize("n", range(1, 10))
+def test_small_blocks_meet_every_constraint_or_raise(n):
+    rng = np.random.default_rng(n)
+    for target_prob, lead, min_gap, max_run in itertools.product((0, 0.2, 1 / 3, 0.5), (0, 1, 2), (0, 1, 2, 3), (None, 1, 2, 3, 4)):
+        k = round(n * target_prob)
+        lead_used = min(lead, n)
+        possible = feasible(n, k, lead_used, min_gap, max_run)
+        for _ in range(5):
+            try:
+                is_target = generate_sequence(rng, n, target_prob, lead, min_gap, max_run)
+            except ValueError:
+                assert not possible, (n, target_prob, lead, min_gap, max_run)
+                break
+            assert possible, (n, target_prob, lead, min_gap, max_run)
+            assert not violations(is_target, n, k, lead_used, min_gap, max_run), (is_target, n, target_prob, lead, min_gap, max_run)
+
+@pytest.mark.parametrize("n, max_run", [(400, 8), (1000, 10), (10000, 20), (10000, None)])
+def test_long_blocks(n, max_run):
+    rng = np.random.default_rng(0)
+    for min_gap in (0, 1, 2):
+        is_target = generate_sequence(rng, n, 0.2, 1, min_gap, max_run)
+        assert not violations(is_target, n, round(n * 0.2), 1, min_gap, max_run)
+
+def test_max_run_below_min_gap_raises():
+    with pytest.raises(ValueError):
+        generate_sequence(np.random.default_rng(1), 6, 1 / 3, 1, 2, 1)